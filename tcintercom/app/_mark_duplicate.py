@@ -1,14 +1,26 @@
+import asyncio
+import contextvars
 import logging
+import queue
+import threading
 import time
 from functools import cached_property
-from typing import Optional
+from typing import Callable, Iterable, Iterator, Optional
 
 import logfire
 
+from tcintercom.app.run_stats import current_run_stats
+from tcintercom.app.settings import app_settings
 from tcintercom.app.views import intercom_request
+from tcintercom.app.write_queue import enqueue_contact_updates
 
 logger = logging.getLogger('tc-intercom.mark_duplicate')
 
+GMAIL_DOMAINS = {'gmail.com', 'googlemail.com'}
+# the most contacts Intercom returns in a page
+MAX_PAGE_SIZE = 150
+_DONE = object()
+
 
 class DuplicateContactChecks:
     def __init__(self, keep_contact: Optional[dict], contact: dict):
@@ -58,34 +70,184 @@ class DuplicateContactChecks:
         )
 
 
-def list_all_contacts() -> list:
+def trim_contact(contact: dict) -> dict:
     """
-    Makes a request to intercom and returns a list of all contacts that were active in the last 91 days
+    Returns a copy of the contact with only the fields used to find duplicates and update them.
+    """
+    return {
+        'id': contact['id'],
+        'email': contact.get('email'),
+        'role': contact.get('role'),
+        'created_at': contact.get('created_at'),
+        'last_seen_at': contact.get('last_seen_at'),
+        'custom_attributes': {'is_duplicate': (contact.get('custom_attributes') or {}).get('is_duplicate')},
+    }
+
+
+def trim_contact_hook(obj: dict) -> dict:
+    """
+    JSON object_hook for pages of contacts, each contact is trimmed as soon as it's decoded so the rest of it (location,
+    tags, companies, other custom attributes etc) can be freed straight away rather than kept for the whole page.
+    """
+    return trim_contact(obj) if obj.get('type') == 'contact' else obj
+
+
+def _fetch_contact_pages() -> Iterator[list]:
+    """
+    Makes requests to intercom, yielding each page of contacts until we reach contacts that haven't been active in
+    the last 91 days
     """
-    response = intercom_request('/contacts?per_page=150')
-    contacts = response['data']
     # - 91 days
     active_time = int(time.time()) - 7862400
-    # number seen in last 90 days/ 10
-    while not (response['data'][0].get('last_seen_at') and response['data'][0].get('last_seen_at') < active_time):
-        response = intercom_request(
-            f'/contacts?per_page=150&starting_after={response["pages"]["next"]["starting_after"]}'
-        )
-        contacts += response['data']
+    starting_after = None
+    while True:
+        # always the largest page, smaller pages only mean more requests against the same rate limit
+        url = f'/contacts?per_page={MAX_PAGE_SIZE}'
+        if starting_after:
+            url += f'&starting_after={starting_after}'
+        response = intercom_request(url, max_retries=app_settings.ic_max_retries, object_hook=trim_contact_hook)
+        yield response['data']
+
+        next_page = (response.get('pages') or {}).get('next')
+        if not response['data'] or not next_page:
+            return
+        last_seen_at = response['data'][0].get('last_seen_at')
+        if last_seen_at and last_seen_at < active_time:
+            return
+        starting_after = next_page['starting_after']
+
+
+def _prefetch(items: Iterator, size: int) -> Iterator:
+    """
+    Runs the iterator in a background thread, fetching up to size items ahead of the consumer so the next one is being
+    fetched while the current one is used. Errors are raised in the consumer.
+    """
+    ready = queue.Queue()
+    # a slot is taken before fetching an item and freed when the consumer takes it
+    slots = threading.Semaphore(size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            while True:
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                try:
+                    item = next(items)
+                except StopIteration:
+                    ready.put((_DONE, None))
+                    return
+                ready.put((item, None))
+        except Exception as e:
+            ready.put((None, e))
+
+    # the thread runs in a copy of the context so requests are still counted against the current run
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(produce,), name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error:
+                raise error
+            if item is _DONE:
+                return
+            slots.release()
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_contact_pages(prefetch: Optional[int] = None) -> Iterator[list]:
+    """
+    Yields each page of contacts active in the last 91 days, fetching up to prefetch (default contact_page_prefetch)
+    pages ahead of the caller.
+    """
+    prefetch = app_settings.contact_page_prefetch if prefetch is None else prefetch
+    pages = _fetch_contact_pages()
+    return _prefetch(pages, prefetch) if prefetch > 0 else pages
 
-    return contacts
+
+def iter_all_contacts() -> Iterator[dict]:
+    """
+    Yields all contacts that were active in the last 91 days as their pages arrive, so they can be deduped while the
+    next pages are fetched. Pages and contacts are counted in the run's stats.
+    """
+    stats = current_run_stats.get()
+    for page in iter_contact_pages():
+        if stats:
+            stats.pages += 1
+            stats.contacts += len(page)
+        yield from page
+
+
+def list_all_contacts() -> list:
+    """
+    Makes a request to intercom and returns a list of all contacts that were active in the last 91 days
+    """
+    return list(iter_all_contacts())
 
 
-def get_relevant_accounts(recently_active: list) -> tuple[list, list]:
+def normalise_email(email: Optional[str], provider_rules: bool = False) -> Optional[str]:
     """
-    Filters through and assigns contacts as either duplicate or not
+    Strips and lower cases the email, returning None if there isn't one. With provider_rules, dots and plus tags are
+    also removed from Gmail addresses as Gmail ignores them.
+    """
+    if not isinstance(email, str) or not (email := email.strip().lower()):
+        return None
+    if provider_rules:
+        local, _, domain = email.rpartition('@')
+        if local and domain in GMAIL_DOMAINS:
+            email = f'{local.split("+", 1)[0].replace(".", "")}@gmail.com'
+    return email
+
+
+class EmailIndex:
     """
-    keep_contacts = {}
+    Hash index of the contact to keep for each normalised email, built once per run. stats counts the contacts looked
+    up, those without an email, those matching a contact already in the index and how many of those matches were only
+    found because of normalisation.
+    """
+
+    def __init__(self, provider_rules: bool = False):
+        self.provider_rules = provider_rules
+        self.keep_contacts = {}
+        self.stats = {'contacts': 0, 'missing_email': 0, 'hits': 0, 'normalised_hits': 0}
+
+    def lookup(self, contact: dict) -> tuple[Optional[str], Optional[dict]]:
+        """
+        Returns the contact's normalised email and the contact currently kept for that email.
+        """
+        self.stats['contacts'] += 1
+        email = normalise_email(contact.get('email'), self.provider_rules)
+        if email is None:
+            self.stats['missing_email'] += 1
+            return None, None
+        keep_contact = self.keep_contacts.get(email)
+        if keep_contact:
+            self.stats['hits'] += 1
+            if keep_contact.get('email') != contact.get('email'):
+                self.stats['normalised_hits'] += 1
+        return email, keep_contact
+
+
+def get_relevant_accounts(recently_active: Iterable[dict]) -> tuple[list, list]:
+    """
+    Filters through and assigns contacts as either duplicate or not. Contacts without an email are never duplicates.
+    """
+    index = EmailIndex(provider_rules=app_settings.dedupe_email_provider_rules)
+    keep_contacts = index.keep_contacts
     mark_dupe_contacts = []
+    no_email_contacts = []
 
     for contact in recently_active:
-        email = contact['email']
-        keep_contact = keep_contacts.get(email)
+        email, keep_contact = index.lookup(contact)
+        if email is None:
+            no_email_contacts.append(contact)
+            continue
         contact_checks = DuplicateContactChecks(contact=contact, keep_contact=keep_contact)
         if contact_checks.check_new_contact:
             keep_contacts[email] = contact
@@ -101,27 +263,51 @@ def get_relevant_accounts(recently_active: list) -> tuple[list, list]:
         else:
             mark_dupe_contacts.append(contact)
 
-    keep_con_list = [v for k, v in keep_contacts.items()]
+    logfire.info(
+        'Indexed {contacts} contacts by {unique_emails} emails with {hits} hits.',
+        unique_emails=len(keep_contacts),
+        **index.stats,
+    )
+    keep_con_list = [v for k, v in keep_contacts.items()] + no_email_contacts
     return mark_dupe_contacts, keep_con_list
 
 
-def update_duplicate_custom_attribute(contacts_to_update: list, mark_duplicate: bool):
+def update_duplicate_custom_attribute(
+    contacts_to_update: list, mark_duplicate: bool, check_lock: Optional[Callable[[], None]] = None
+):
     """
     Takes a list of contacts and depending on what mark duplicate is, marks them as a duplicate or not a duplicate.
+    check_lock is called before each update so we stop if another run has taken over. Returns the number written to
+    Intercom, with the write queue on nothing is written here so the updates queued are counted in the run's stats.
     """
-    updated = 0
+    updated, queued = [], []
     for contact in contacts_to_update:
         if contact['custom_attributes'].get('is_duplicate') != mark_duplicate:
-            url = f'/contacts/{contact["id"]}'
             data = {
                 'role': contact['role'],
                 'email': contact['email'],
                 'custom_attributes': {'is_duplicate': mark_duplicate},
             }
-            intercom_request(url, method='PUT', data=data)
-            updated += 1
+            if app_settings.contact_write_queue:
+                queued.append((contact['id'], data))
+            else:
+                if check_lock:
+                    check_lock()
+                url = f'/contacts/{contact["id"]}'
+                intercom_request(url, method='PUT', data=data, max_retries=app_settings.ic_max_retries)
+                updated.append(contact['id'])
+    duplicate = 'duplicate' if mark_duplicate else 'not duplicate'
+    if queued:
+        if check_lock:
+            check_lock()
+        asyncio.run(enqueue_contact_updates(queued))
+        if stats := current_run_stats.get():
+            stats.queued += len(queued)
+        logfire.info('Queued updates to {queued} contacts to {duplicate}', queued=len(queued), duplicate=duplicate)
+        return 0
     logfire.info(
         'Updated {updated} contacts to {duplicate}',
-        updated=updated,
-        duplicate='duplicate' if mark_duplicate else 'not duplicate',
+        updated=len(updated),
+        duplicate=duplicate,
     )
+    return len(updated)
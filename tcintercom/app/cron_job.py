@@ -4,18 +4,24 @@ from pathlib import Path
 
 import logfire
 from logfire import ConsoleOptions
+from redis import Redis
 
 project_root = Path(__file__).resolve().parent.parent.parent
 sys.path.append(str(project_root))
-from tcintercom.app._mark_duplicate import get_relevant_accounts, list_all_contacts, update_duplicate_custom_attribute
+from tcintercom.app._mark_duplicate import get_relevant_accounts, iter_all_contacts, update_duplicate_custom_attribute
+from tcintercom.app.job_lock import JobLock
 from tcintercom.app.logs import logfire_setup
+from tcintercom.app.partitioned import run_partitioned, split_partitions
+from tcintercom.app.run_stats import RunStats, current_run_stats, save_run
+from tcintercom.app.settings import app_settings
 
 logger = logging.getLogger('tc-intercom.cron_job')
 
 
-def update_duplicate_contacts():
+def update_duplicate_contacts(wait: bool = False):
     """
-    Updates intercom with the relevant duplicate/not duplicate contacts
+    Updates intercom with the relevant duplicate/not duplicate contacts. If another run is already in progress this
+    run is skipped, or with wait, follows the other run's progress until it finishes.
     """
     console_options = ConsoleOptions(
         colors='auto',
@@ -24,18 +30,58 @@ def update_duplicate_contacts():
         min_log_level='info',
     )
     logfire_setup(service_name='cron-job', console=console_options)
-    with logfire.span('Updating duplicate/not duplicate contacts.'):
-        contacts = list_all_contacts()
-        logfire.info('Found {contacts} contacts.', contacts=len(contacts))
-        mark_duplicate, mark_not_duplicate = get_relevant_accounts(contacts)
-        logfire.info(
-            'Updating {duplicates} duplicate contacts and {not_duplicates} not duplicate contacts.',
-            duplicates=len(mark_duplicate),
-            not_duplicates=len(mark_not_duplicate),
-        )
-        update_duplicate_custom_attribute(contacts_to_update=mark_duplicate, mark_duplicate=True)
-        update_duplicate_custom_attribute(contacts_to_update=mark_not_duplicate, mark_duplicate=False)
+    redis = Redis.from_url(app_settings.redis_url)
+    lock = JobLock(redis, 'duplicate-job', ttl=app_settings.duplicate_job_lock_ttl)
+    if not lock.acquire():
+        if wait:
+            logfire.info('Duplicate contacts job already running, waiting for it.')
+            lock.wait()
+        else:
+            logfire.info('Duplicate contacts job already running, skipping.', **lock.get_progress())
+        return
+
+    stats = RunStats()
+    stats_token = current_run_stats.set(stats)
+    try:
+        with logfire.span('Updating duplicate/not duplicate contacts.', fence=lock.token):
+            # contacts are partitioned or deduped as their pages arrive, while the next pages are fetched
+            lock.set_progress(phase='fetching')
+            if (partitions := app_settings.duplicate_job_partitions) > 1:
+                with stats.phase('fetch'):
+                    split = split_partitions(iter_all_contacts(), partitions)
+                logfire.info('Found {contacts} contacts.', contacts=stats.contacts)
+                lock.set_progress(phase='updating', contacts=stats.contacts, partitions=partitions)
+                with stats.phase('partitions'):
+                    totals = run_partitioned(split, fence=lock.token)
+                stats.updated = totals['updated']
+                stats.queued = totals['queued']
+                stats.add_requests(totals)
+            else:
+                with stats.phase('fetch_dedupe'):
+                    mark_duplicate, mark_not_duplicate = get_relevant_accounts(iter_all_contacts())
+                logfire.info('Found {contacts} contacts.', contacts=stats.contacts)
+                logfire.info(
+                    'Updating {duplicates} duplicate contacts and {not_duplicates} not duplicate contacts.',
+                    duplicates=len(mark_duplicate),
+                    not_duplicates=len(mark_not_duplicate),
+                )
+                lock.set_progress(
+                    phase='updating', duplicates=len(mark_duplicate), not_duplicates=len(mark_not_duplicate)
+                )
+                with stats.phase('update'):
+                    stats.updated = update_duplicate_custom_attribute(
+                        mark_duplicate, mark_duplicate=True, check_lock=lock.check
+                    ) + update_duplicate_custom_attribute(
+                        mark_not_duplicate, mark_duplicate=False, check_lock=lock.check
+                    )
+        stats.status = 'success'
+    finally:
+        current_run_stats.reset(stats_token)
+        lock.release()
+        record = stats.record()
+        save_run(redis, record, keep=app_settings.duplicate_job_history)
+        logfire.info('Duplicate contacts job {status} in {duration}s.', **record)
 
 
 if __name__ == '__main__':
-    update_duplicate_contacts()  # pragma: no cover
+    update_duplicate_contacts(wait='--wait' in sys.argv)  # pragma: no cover
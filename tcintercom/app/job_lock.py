@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+import logfire
+from redis import Redis
+
+logger = logging.getLogger('tc-intercom.job_lock')
+
+# Takes the lock if it's free, the lock's value is a fencing token which increases every time the lock is taken.
+ACQUIRE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return false
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token, 'PX', ARGV[1])
+redis.call('DEL', KEYS[3])
+redis.call('HSET', KEYS[3], 'fence', token, 'phase', 'started', 'started_at', ARGV[2])
+redis.call('PEXPIRE', KEYS[3], ARGV[1])
+return token
+"""
+# Extends the lock and its progress if we still hold it.
+EXTEND = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+  return 0
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+# Removes the lock and marks its progress finished, only if we still hold it so a run that has been taken over doesn't
+# touch the new run's lock or progress.
+RELEASE = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+  return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[2], 'phase', 'finished')
+return 1
+"""
+
+
+class LockLost(RuntimeError):
+    pass
+
+
+class JobLock:
+    """
+    Lease lock in Redis so only one run of a job happens at a time. The lease expires after ttl seconds unless it's
+    extended by the heartbeat thread, so a run that dies doesn't hold the lock forever. Each run gets a fencing token,
+    check() should be called before writes so a run that has lost its lease (eg. after a long pause) stops rather than
+    racing the run that took over.
+
+    The run's progress is kept in a hash alongside the lock so other runs can follow it.
+    """
+
+    def __init__(self, redis: Redis, name: str, ttl: float):
+        self.redis = redis
+        self.lock_key = f'{name}:lock'
+        self.fence_key = f'{name}:fence'
+        self.progress_key = f'{name}:progress'
+        self.ttl_ms = int(ttl * 1000)
+        self.token: Optional[int] = None
+        self._acquire = redis.register_script(ACQUIRE)
+        self._extend = redis.register_script(EXTEND)
+        self._release = redis.register_script(RELEASE)
+        self._lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @classmethod
+    def held(cls, redis: Redis, name: str, token: int) -> 'JobLock':
+        """
+        A handle on a lock held by another process (eg. the coordinator of a partitioned job), only for calling
+        check().
+        """
+        lock = cls(redis, name, ttl=0)
+        lock.token = token
+        return lock
+
+    def acquire(self) -> bool:
+        keys = [self.lock_key, self.fence_key, self.progress_key]
+        self.token = self._acquire(keys=keys, args=[self.ttl_ms, int(time.time())])
+        if self.token is None:
+            return False
+        self._heartbeat = threading.Thread(target=self._beat, name=f'{self.lock_key}-heartbeat', daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl_ms / 3000):
+            if not self._extend(keys=[self.lock_key, self.progress_key], args=[self.token, self.ttl_ms]):
+                self._lost.set()
+                logfire.warn('Lost lock {lock} with fencing token {token}', lock=self.lock_key, token=self.token)
+                return
+
+    def check(self):
+        """
+        Raises LockLost if another run may have taken over.
+        """
+        if self._lost.is_set() or self.redis.get(self.lock_key) != str(self.token).encode():
+            raise LockLost(f'{self.lock_key} with fencing token {self.token} is no longer held')
+
+    def set_progress(self, **progress):
+        self.redis.hset(self.progress_key, mapping=progress)
+
+    def get_progress(self) -> dict:
+        return {k.decode(): v.decode() for k, v in self.redis.hgetall(self.progress_key).items()}
+
+    def is_locked(self) -> bool:
+        return bool(self.redis.exists(self.lock_key))
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        if self.token is not None:
+            self._release(keys=[self.lock_key, self.progress_key], args=[self.token])
+
+    def wait(self, poll: float = 5) -> dict:
+        """
+        Follows the progress of the run holding the lock until it finishes, returning its final progress.
+        """
+        progress = {}
+        while self.is_locked():
+            if (latest := self.get_progress()) != progress:
+                progress = latest
+                logfire.info('Waiting for run {fence}: {phase}', **{'fence': None, 'phase': None, **progress})
+            time.sleep(poll)
+        return self.get_progress()
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Optional
+
+import logfire
+
+logger = logging.getLogger('tc-intercom.loop_monitor')
+
+
+def percentile(values, pct: float) -> float:
+    """
+    Returns the pct percentile of values using linear interpolation, 0 if there are no values.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class LoopLagProbe:
+    """
+    Repeatedly sleeps for interval seconds and records how late the event loop woke it up.
+    """
+
+    def __init__(self, interval: float = 0.01, max_samples: Optional[int] = None):
+        self.interval = interval
+        self.lags = deque(maxlen=max_samples)
+        self.heartbeat = time.monotonic()
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.heartbeat = time.monotonic()
+            self.lags.append(max(0.0, self.heartbeat - start - self.interval))
+
+    def summary(self) -> dict:
+        return {
+            'samples': len(self.lags),
+            'mean': sum(self.lags) / len(self.lags) if self.lags else 0.0,
+            'p99': percentile(self.lags, 99),
+            'max': max(self.lags, default=0.0),
+        }
+
+
+class LoopMonitor:
+    """
+    Watches the event loop from a separate thread. When a callback holds the loop for longer than threshold seconds,
+    the loop thread's stack is sampled every interval until the loop is released and the most common stack is reported
+    as a warning.
+    """
+
+    def __init__(self, threshold: float, interval: float):
+        self.threshold = threshold
+        self.probe = LoopLagProbe(interval, max_samples=1000)
+        self._stop = threading.Event()
+        self._task = None
+        self._thread = None
+        self._loop_thread_id = None
+
+    def start(self):
+        """
+        Must be called from the event loop to be monitored.
+        """
+        self._loop_thread_id = threading.get_ident()
+        self.probe.heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self.probe.run())
+        self._thread = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+        if self._thread:
+            self._thread.join()
+
+    def _blocked_for(self) -> float:
+        return time.monotonic() - self.probe.heartbeat - self.probe.interval
+
+    def _watch(self):
+        stacks, longest = Counter(), 0.0
+        while not self._stop.wait(self.probe.interval):
+            blocked = self._blocked_for()
+            if blocked > self.threshold:
+                if frame := sys._current_frames().get(self._loop_thread_id):
+                    stacks[''.join(traceback.format_stack(frame))] += 1
+                longest = max(longest, blocked)
+            elif stacks:
+                self._report(stacks, longest)
+                stacks, longest = Counter(), 0.0
+
+    def _report(self, stacks: Counter, blocked: float):
+        stack, count = stacks.most_common(1)[0]
+        logfire.warn(
+            'Event loop blocked for {blocked_ms:.0f}ms',
+            blocked_ms=blocked * 1000,
+            samples=sum(stacks.values()),
+            stack_samples=count,
+            stack=stack,
+        )
+
+
+class _TimedCoroutine:
+    """
+    Drives a coroutine, timing each step it runs on the event loop. cpu is the CPU time used by those steps and
+    on_loop is their wall time, which also includes any blocking (eg. synchronous I/O) done on the loop.
+    """
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.cpu = 0.0
+        self.on_loop = 0.0
+
+    def _step(self, value, exc):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return self.coro.throw(exc) if exc is not None else self.coro.send(value)
+        finally:
+            self.on_loop += time.perf_counter() - wall
+            self.cpu += time.thread_time() - cpu
+
+    def __await__(self):
+        value, exc = None, None
+        while True:
+            try:
+                yielded = self._step(value, exc)
+            except StopIteration as e:
+                return e.value
+            try:
+                value, exc = (yield yielded), None
+            except GeneratorExit:
+                self.coro.close()
+                raise
+            except BaseException as e:
+                value, exc = None, e
+
+
+class RequestTimingMiddleware:
+    """
+    Splits each request's wall time into CPU used on the event loop, time spent blocking the loop without using CPU
+    and time spent awaiting. Requests slower than threshold seconds are reported as warnings.
+    """
+
+    def __init__(self, app, threshold: float):
+        self.app = app
+        self.threshold = threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        timed = _TimedCoroutine(self.app(scope, receive, send))
+        try:
+            await timed
+        finally:
+            wall = time.perf_counter() - start
+            if wall > self.threshold:
+                logfire.warn(
+                    'Slow request {method} {path} took {wall_ms:.0f}ms',
+                    method=scope['method'],
+                    path=scope['path'],
+                    wall_ms=wall * 1000,
+                    cpu_ms=timed.cpu * 1000,
+                    blocking_ms=(timed.on_loop - timed.cpu) * 1000,
+                    await_ms=(wall - timed.on_loop) * 1000,
+                )
@@ -8,6 +8,7 @@ from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from starlette.middleware.cors import CORSMiddleware
 
 from .logs import logfire_setup
+from .loop_monitor import LoopMonitor, RequestTimingMiddleware
 from .routers.views import views_router
 from .settings import app_settings
 
@@ -16,7 +17,13 @@ from .settings import app_settings
 async def lifespan(app):
     app.settings = app_settings
     app.redis = await create_pool(app.settings.redis_settings)
+    app.loop_monitor = None
+    if app.settings.loop_monitor:
+        app.loop_monitor = LoopMonitor(app.settings.loop_monitor_threshold, app.settings.loop_monitor_interval)
+        app.loop_monitor.start()
     yield
+    if app.loop_monitor:
+        app.loop_monitor.stop()
 
 
 def create_app():
@@ -28,6 +35,9 @@ def create_app():
         allowed_origins = ['*']
     app.add_middleware(CORSMiddleware, allow_origins=allowed_origins, allow_methods=['*'], allow_headers=['*'])
 
+    if app_settings.loop_monitor:
+        app.add_middleware(RequestTimingMiddleware, threshold=app_settings.loop_monitor_threshold)
+
     if app_settings.logfire_token:
         logfire_setup('web')
         logfire.instrument_fastapi(app)
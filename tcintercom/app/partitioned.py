@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+
+import logfire
+from arq import create_pool
+from redis import Redis
+
+from tcintercom.app._mark_duplicate import (
+    get_relevant_accounts,
+    normalise_email,
+    trim_contact,
+    update_duplicate_custom_attribute,
+)
+from tcintercom.app.job_lock import JobLock
+from tcintercom.app.logs import logfire_setup
+from tcintercom.app.run_stats import RunStats, current_run_stats
+from tcintercom.app.settings import app_settings
+
+logger = logging.getLogger('tc-intercom.partitioned')
+
+
+def partition_for(email: Optional[str], partitions: int) -> int:
+    """
+    Returns the partition for a contact's email, hashing the normalised email so every contact that could be a
+    duplicate of another ends up in the same partition.
+    """
+    email = normalise_email(email, app_settings.dedupe_email_provider_rules)
+    if email is None:
+        return 0
+    return int.from_bytes(hashlib.blake2b(email.encode(), digest_size=8).digest(), 'big') % partitions
+
+
+def split_partitions(contacts: Iterable[dict], partitions: int) -> list[list]:
+    """
+    Splits contacts into partitions, trimming them to the fields needed so they're cheap to send to each worker.
+    """
+    split = [[] for _ in range(partitions)]
+    for contact in contacts:
+        split[partition_for(contact.get('email'), partitions)].append(trim_contact(contact))
+    return split
+
+
+def dedupe_partition(partition: int, contacts: list, fence: Optional[int] = None) -> dict:
+    """
+    Finds the duplicates in one partition and updates them. fence is the fencing token of the coordinator's lock,
+    updates stop if it has been lost.
+    """
+    check_lock = None
+    if fence is not None:
+        check_lock = JobLock.held(Redis.from_url(app_settings.redis_url), 'duplicate-job', fence).check
+    stats = RunStats()
+    stats_token = current_run_stats.set(stats)
+    try:
+        with logfire.span('Updating duplicate contacts in partition {partition}.', partition=partition):
+            mark_duplicate, mark_not_duplicate = get_relevant_accounts(contacts)
+            return {
+                'partition': partition,
+                'contacts': len(contacts),
+                'duplicates': len(mark_duplicate),
+                'not_duplicates': len(mark_not_duplicate),
+                'updated_duplicate': update_duplicate_custom_attribute(mark_duplicate, True, check_lock=check_lock),
+                'updated_not_duplicate': update_duplicate_custom_attribute(
+                    mark_not_duplicate, False, check_lock=check_lock
+                ),
+                'queued': stats.queued,
+                **stats.requests(),
+            }
+    finally:
+        current_run_stats.reset(stats_token)
+
+
+async def dedupe_partition_job(ctx, partition: int, contacts: list, fence: Optional[int] = None) -> dict:
+    """
+    arq job running dedupe_partition on a worker.
+    """
+    return await asyncio.to_thread(dedupe_partition, partition, contacts, fence)
+
+
+async def _run_arq_partitions(split: list[list], fence: Optional[int]) -> list[dict]:
+    """
+    Runs the partitions as arq jobs, failing if they haven't all finished within duplicate_job_partition_timeout (eg.
+    if no worker is running) so the run releases its lock. Jobs that start after that stop at their first update as
+    the lock has gone.
+    """
+    timeout = app_settings.duplicate_job_partition_timeout
+    redis = await create_pool(app_settings.redis_settings)
+    try:
+        jobs = [
+            await redis.enqueue_job('dedupe_partition_job', partition, contacts, fence)
+            for partition, contacts in enumerate(split)
+        ]
+        try:
+            return list(await asyncio.gather(*(job.result(timeout=timeout, poll_delay=1) for job in jobs)))
+        except asyncio.TimeoutError as e:
+            raise TimeoutError(f'Partitions not finished by the arq workers within {timeout}s') from e
+    finally:
+        await redis.aclose()
+
+
+def run_partitioned(split: list[list], fence: Optional[int] = None) -> dict:
+    """
+    Dedupes and updates each partition from split_partitions in parallel, either in local processes or as arq jobs
+    depending on duplicate_job_partition_mode. Returns the totals across all partitions.
+    """
+    partitions = len(split)
+    if app_settings.duplicate_job_partition_mode == 'arq':
+        results = asyncio.run(_run_arq_partitions(split, fence))
+    else:
+        # spawn rather than fork as the lock's heartbeat thread is running, spawned processes need logfire set up again
+        with ProcessPoolExecutor(
+            partitions,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=logfire_setup,
+            initargs=('cron-job',),
+        ) as executor:
+            results = list(executor.map(dedupe_partition, range(partitions), split, [fence] * partitions))
+
+    totals = {
+        k: sum(r[k] for r in results)
+        for k in ('duplicates', 'not_duplicates', 'queued', 'api_calls', 'retries', 'rate_limit_wait')
+    }
+    totals.update(updated=sum(r['updated_duplicate'] + r['updated_not_duplicate'] for r in results))
+    logfire.info(
+        'Updated {updated} and queued {queued} contacts across {partitions} partitions.',
+        partitions=partitions,
+        sizes=[r['contacts'] for r in results],
+        **totals,
+    )
+    return totals
@@ -2,7 +2,7 @@ from fastapi import APIRouter
 from starlette.requests import Request
 from starlette.responses import FileResponse
 
-from ..views import handle_blog_callback, handle_intercom_callback
+from ..views import handle_blog_callback, handle_duplicate_job_runs, handle_intercom_callback
 
 views_router = APIRouter()
 
@@ -30,3 +30,8 @@ async def callback(request: Request):
 @views_router.post('/blog-callback/', name='blog-callback')
 async def blog_callback(request: Request):
     return await handle_blog_callback(request)
+
+
+@views_router.get('/duplicate-job/runs/', name='duplicate-job-runs')
+async def duplicate_job_runs(request: Request, limit: int = 20):
+    return await handle_duplicate_job_runs(request, limit)
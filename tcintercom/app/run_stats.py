@@ -0,0 +1,91 @@
+import json
+import logging
+import resource
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from redis import Redis
+
+logger = logging.getLogger('tc-intercom.run_stats')
+
+RUNS_KEY = 'duplicate-job:runs'
+
+
+class RunStats:
+    """
+    Timings and counts for one run of the duplicate job. Requests to Intercom made while it's set as
+    current_run_stats are counted against it.
+    """
+
+    def __init__(self):
+        self.started_at = int(time.time())
+        self.status = 'failed'
+        self.phases = {}
+        self.pages = 0
+        self.api_calls = 0
+        self.retries = 0
+        self.rate_limit_wait = 0.0
+        self.contacts = 0
+        self.updated = 0
+        # updates sent to the write queue rather than written to Intercom by the job
+        self.queued = 0
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def add_requests(self, stats: dict):
+        """
+        Adds the request counts from a run somewhere else, eg. a partition.
+        """
+        self.api_calls += stats['api_calls']
+        self.retries += stats['retries']
+        self.rate_limit_wait += stats['rate_limit_wait']
+
+    def requests(self) -> dict:
+        return {'api_calls': self.api_calls, 'retries': self.retries, 'rate_limit_wait': self.rate_limit_wait}
+
+    def record(self) -> dict:
+        duration = time.perf_counter() - self._start
+        # ru_maxrss is in KB on Linux, children covers partitions run in local processes
+        peak_rss = max(resource.getrusage(r).ru_maxrss for r in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+        return {
+            'started_at': self.started_at,
+            'status': self.status,
+            'duration': round(duration, 3),
+            'phases': {k: round(v, 3) for k, v in self.phases.items()},
+            'pages': self.pages,
+            'contacts': self.contacts,
+            'updated': self.updated,
+            'queued': self.queued,
+            **self.requests(),
+            'contacts_per_second': round(self.contacts / duration, 1) if duration else 0,
+            'peak_rss_mb': round(peak_rss / 1024, 1),
+        }
+
+
+current_run_stats: ContextVar[Optional[RunStats]] = ContextVar('current_run_stats', default=None)
+
+
+def save_run(redis: Redis, record: dict, keep: int):
+    """
+    Adds the record to the run history, keeping the most recent keep runs.
+    """
+    with redis.pipeline() as pipe:
+        pipe.lpush(RUNS_KEY, json.dumps(record))
+        pipe.ltrim(RUNS_KEY, 0, keep - 1)
+        pipe.execute()
+
+
+async def get_runs(redis, limit: int) -> list[dict]:
+    """
+    Returns the most recent runs first, redis is the app's async connection.
+    """
+    return [json.loads(r) for r in await redis.lrange(RUNS_KEY, 0, limit - 1)]
@@ -1,3 +1,4 @@
+from typing import Literal
 from urllib.parse import urlparse
 
 from arq.connections import RedisSettings
@@ -8,6 +9,7 @@ class Settings(BaseSettings):
     testing: bool = False
     ic_secret_token: str = ''
     ic_client_secret: str = ''
+    ic_api_url: str = 'https://api.intercom.io'
     redis_url: str = 'redis://localhost:6379'
     tc_url: str = 'http://tutorcruncher.com'
     netlify_key: str = ''
@@ -16,6 +18,33 @@ class Settings(BaseSettings):
     log_level: str = 'INFO'
     dev_mode: bool = False
 
+    # reports callbacks holding the event loop, and requests, for longer than loop_monitor_threshold seconds
+    loop_monitor: bool = False
+    loop_monitor_threshold: float = 0.1
+    loop_monitor_interval: float = 0.02
+
+    # also ignore dots and plus tags in Gmail addresses when grouping contacts by email to find duplicates
+    dedupe_email_provider_rules: bool = False
+
+    # seconds before the duplicate job's lock expires if its heartbeat stops
+    duplicate_job_lock_ttl: float = 60
+    # splits the duplicate job by email across this many local processes ('local') or arq workers ('arq')
+    duplicate_job_partitions: int = 1
+    duplicate_job_partition_mode: Literal['local', 'arq'] = 'local'
+    # seconds a partition may take on the arq workers, including waiting to be picked up, before the run fails
+    duplicate_job_partition_timeout: float = 3600
+    # number of duplicate job runs kept in the run history
+    duplicate_job_history: int = 100
+    # times requests made by jobs are retried when rate limited by Intercom
+    ic_max_retries: int = 3
+    # pages of contacts fetched ahead of the duplicate job while it dedupes the pages it already has
+    contact_page_prefetch: int = 2
+
+    # sends contact updates through the arq worker so updates to the same contact are merged and written one at a time
+    contact_write_queue: bool = False
+    contact_write_delay: float = 2
+    contact_write_concurrency: int = 10
+
     @property
     def redis_settings(self):
         conf = urlparse(self.redis_url)
@@ -0,0 +1,257 @@
+"""
+Snapshots of Intercom contacts for analysing duplicates offline.
+
+A snapshot file is the MAGIC header followed by any number of chunks, one per page of contacts, so a snapshot can be
+appended to. Each chunk is a CHUNK_HEADER (marker, row count, column count) followed by one zlib compressed column per
+field in SNAPSHOT_FIELDS, each prefixed by its compressed length. Strings are stored as JSON lists, timestamps as
+doubles (NaN for missing) and is_duplicate as signed bytes (-1 for missing). Files are read through mmap so only the
+columns of the chunk being decoded are held in memory. When a contact appears more than once (eg. after appending a
+later crawl) the last row for it is the one used.
+"""
+
+import argparse
+import json
+import logging
+import math
+import mmap
+import struct
+import zlib
+from array import array
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+from tcintercom.app._mark_duplicate import get_relevant_accounts, iter_contact_pages, trim_contact
+
+logger = logging.getLogger('tc-intercom.snapshot')
+
+MAGIC = b'TCICSNP1'
+CHUNK_MARKER = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sII')
+COLUMN_LENGTH = struct.Struct('<I')
+SNAPSHOT_FIELDS = ('id', 'email', 'role', 'created_at', 'last_seen_at', 'is_duplicate')
+_STRING_FIELDS = ('id', 'email', 'role')
+_TIMESTAMP_FIELDS = ('created_at', 'last_seen_at')
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _encode_column(name: str, values: list) -> bytes:
+    if name in _STRING_FIELDS:
+        data = json.dumps(values, separators=(',', ':')).encode()
+    elif name in _TIMESTAMP_FIELDS:
+        data = array('d', (math.nan if v is None else v for v in values)).tobytes()
+    else:
+        data = array('b', (-1 if v is None else int(v) for v in values)).tobytes()
+    return zlib.compress(data)
+
+
+def _decode_column(name: str, data: bytes) -> list:
+    data = zlib.decompress(data)
+    if name in _STRING_FIELDS:
+        return json.loads(data)
+    elif name in _TIMESTAMP_FIELDS:
+        return [None if math.isnan(v) else int(v) if v.is_integer() else v for v in array('d', data)]
+    else:
+        return [None if v == -1 else bool(v) for v in array('b', data)]
+
+
+class SnapshotWriter:
+    """
+    Appends chunks of contacts to a snapshot file, creating it if it doesn't exist.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = Path(path)
+        self.file = None
+        self.rows = 0
+
+    def __enter__(self):
+        if self.path.exists() and self.path.stat().st_size:
+            _check_magic(self.path)
+            self._truncate_incomplete()
+        self.file = self.path.open('ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        return self
+
+    def _truncate_incomplete(self):
+        """
+        Cuts off anything after the last complete chunk, eg. left by an interrupted write, so new chunks can be read.
+        """
+        end = len(MAGIC)
+        with self.path.open('r+b') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                size = len(mm)
+                try:
+                    for _, _, end in _chunks(mm, self.path):
+                        pass
+                except SnapshotError:
+                    pass
+            if end < size:
+                logger.warning('Removing %d bytes after the last complete chunk of %s', size - end, self.path)
+                f.truncate(end)
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def append(self, contacts: list):
+        if not contacts:
+            return
+        contacts = [trim_contact(c) for c in contacts]
+        columns = {
+            'id': [c['id'] for c in contacts],
+            'email': [c['email'] for c in contacts],
+            'role': [c['role'] for c in contacts],
+            'created_at': [c['created_at'] for c in contacts],
+            'last_seen_at': [c['last_seen_at'] for c in contacts],
+            'is_duplicate': [c['custom_attributes']['is_duplicate'] for c in contacts],
+        }
+        chunk = [CHUNK_HEADER.pack(CHUNK_MARKER, len(contacts), len(SNAPSHOT_FIELDS))]
+        for name in SNAPSHOT_FIELDS:
+            data = _encode_column(name, columns[name])
+            chunk += [COLUMN_LENGTH.pack(len(data)), data]
+        # a chunk cut off by an interrupted write is removed the next time the snapshot is appended to
+        self.file.write(b''.join(chunk))
+        self.file.flush()
+        self.rows += len(contacts)
+
+
+def _check_magic(path: Path):
+    with path.open('rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise SnapshotError(f'{path} is not a contacts snapshot')
+
+
+def _chunks(mm: mmap.mmap, path: Path) -> Iterator[tuple[int, list[tuple[int, int]], int]]:
+    """
+    Yields the row count, the (offset, length) of each column and the end offset of each chunk, raising SnapshotError
+    at the first chunk that's invalid or cut off.
+    """
+    offset = len(MAGIC)
+    while offset < len(mm):
+        start = offset
+        if offset + CHUNK_HEADER.size > len(mm):
+            raise SnapshotError(f'{path} ends with an incomplete chunk at byte {start}')
+        marker, rows, n_columns = CHUNK_HEADER.unpack_from(mm, offset)
+        if marker != CHUNK_MARKER or n_columns != len(SNAPSHOT_FIELDS):
+            raise SnapshotError(f'{path} has an invalid chunk at byte {start}')
+        offset += CHUNK_HEADER.size
+        columns = []
+        for _ in SNAPSHOT_FIELDS:
+            if offset + COLUMN_LENGTH.size > len(mm):
+                raise SnapshotError(f'{path} ends with an incomplete chunk at byte {start}')
+            (length,) = COLUMN_LENGTH.unpack_from(mm, offset)
+            offset += COLUMN_LENGTH.size
+            if offset + length > len(mm):
+                raise SnapshotError(f'{path} ends with an incomplete chunk at byte {start}')
+            columns.append((offset, length))
+            offset += length
+        yield rows, columns, offset
+
+
+def read_snapshot(path: Union[Path, str]) -> Iterator[dict]:
+    """
+    Yields the contacts in a snapshot in the same shape as trim_contact.
+    """
+    path = Path(path)
+    _check_magic(path)
+    with path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for rows, column_ranges, end in _chunks(mm, path):
+            try:
+                columns = [
+                    _decode_column(name, mm[offset : offset + length])
+                    for name, (offset, length) in zip(SNAPSHOT_FIELDS, column_ranges)
+                ]
+            except (zlib.error, ValueError) as e:
+                raise SnapshotError(f'{path} has a corrupt chunk before byte {end}: {e}') from e
+            if any(len(column) != rows for column in columns):
+                raise SnapshotError(f'{path} has a chunk with mismatched columns before byte {end}')
+            for id_, email, role, created_at, last_seen_at, is_duplicate in zip(*columns):
+                yield {
+                    'id': id_,
+                    'email': email,
+                    'role': role,
+                    'created_at': created_at,
+                    'last_seen_at': last_seen_at,
+                    'custom_attributes': {'is_duplicate': is_duplicate},
+                }
+
+
+def write_snapshot(path: Union[Path, str], pages: Optional[Iterable[list]] = None, append: bool = False) -> int:
+    """
+    Streams pages of contacts, by default all recently active contacts in Intercom, to the snapshot at path, returning
+    the number of contacts written. An existing snapshot is only added to with append.
+    """
+    if not append and Path(path).exists():
+        raise SnapshotError(f'{path} already exists, append to add to it')
+    with SnapshotWriter(path) as writer:
+        for page in pages if pages is not None else iter_contact_pages():
+            writer.append(page)
+    return writer.rows
+
+
+def read_latest(path: Union[Path, str]) -> dict[str, dict]:
+    """
+    Returns the contacts in a snapshot by id, keeping the last row for each contact.
+    """
+    return {c['id']: c for c in read_snapshot(path)}
+
+
+def _updates_needed(contacts: list, mark_duplicate: bool) -> int:
+    return sum(c['custom_attributes'].get('is_duplicate') != mark_duplicate for c in contacts)
+
+
+def dedupe_snapshot(path: Union[Path, str]) -> dict:
+    """
+    Runs the duplicate checks against a snapshot, returning what the cron job would update without making any
+    requests to Intercom.
+    """
+    contacts = list(read_latest(path).values())
+    mark_duplicate, mark_not_duplicate = get_relevant_accounts(contacts)
+    return {
+        'contacts': len(contacts),
+        'duplicates': len(mark_duplicate),
+        'not_duplicates': len(mark_not_duplicate),
+        'mark_duplicate': _updates_needed(mark_duplicate, True),
+        'mark_not_duplicate': _updates_needed(mark_not_duplicate, False),
+    }
+
+
+def compare_snapshots(old_path: Union[Path, str], new_path: Union[Path, str]) -> dict:
+    """
+    Compares two snapshots by contact id.
+    """
+    old = read_latest(old_path)
+    new = read_latest(new_path)
+    both = old.keys() & new.keys()
+    return {
+        'added': len(new.keys() - old.keys()),
+        'removed': len(old.keys() - new.keys()),
+        'email_changed': sum(old[i]['email'] != new[i]['email'] for i in both),
+        'is_duplicate_changed': sum(
+            old[i]['custom_attributes']['is_duplicate'] != new[i]['custom_attributes']['is_duplicate'] for i in both
+        ),
+    }
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(prog='run.py snapshot', description='Snapshot contacts for offline dedupe')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='snapshot all recently active contacts')
+    create.add_argument('path')
+    create.add_argument('--append', action='store_true', help='add to an existing snapshot')
+    commands.add_parser('dedupe', help='run the duplicate checks against a snapshot').add_argument('path')
+    diff = commands.add_parser('diff', help='compare two snapshots')
+    diff.add_argument('old_path')
+    diff.add_argument('new_path')
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        result = {'contacts': write_snapshot(args.path, append=args.append)}
+    elif args.command == 'dedupe':
+        result = dedupe_snapshot(args.path)
+    else:
+        result = compare_snapshots(args.old_path, args.new_path)
+    print(json.dumps(result, indent=2))
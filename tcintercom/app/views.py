@@ -2,14 +2,17 @@ import hashlib
 import hmac
 import json
 import logging
-from typing import Optional
+import time
+from typing import Callable, Optional
 
 import logfire
 import requests
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 
+from tcintercom.app.run_stats import current_run_stats, get_runs
 from tcintercom.app.settings import app_settings
+from tcintercom.app.write_queue import enqueue_contact_update
 
 logger = logging.getLogger('tc-intercom.views')
 session = requests.Session()
@@ -31,9 +34,29 @@ async def validate_ic_webhook_signature(request: Request):
     ), 'Unable to validate signature.'
 
 
-def intercom_request(url: str, data: Optional[dict] = None, method: str = 'GET') -> Optional[dict]:
+def rate_limit_wait(response: requests.Response) -> float:
     """
-    Makes a request to Intercom, takes the url, data and method to use when making the request.
+    Returns how long to wait before retrying a rate limited request, using the X-RateLimit-Reset header (when the
+    rate limit window resets as a unix timestamp).
+    """
+    try:
+        wait = int(response.headers['X-RateLimit-Reset']) - time.time()
+    except (KeyError, ValueError):
+        wait = 1
+    return min(max(wait, 0.5), 10)
+
+
+def intercom_request(
+    url: str,
+    data: Optional[dict] = None,
+    method: str = 'GET',
+    max_retries: int = 0,
+    object_hook: Optional[Callable[[dict], dict]] = None,
+) -> Optional[dict]:
+    """
+    Makes a request to Intercom, takes the url, data and method to use when making the request. Rate limited requests
+    are retried up to max_retries times after waiting for the rate limit to reset. object_hook is passed to the JSON
+    decoder, it's called with each object in the response as it's decoded.
     """
     data = data or {}
     headers = {
@@ -42,13 +65,25 @@ def intercom_request(url: str, data: Optional[dict] = None, method: str = 'GET')
         'Accept': 'application/json',
     }
     if not (method == 'POST' and not app_settings.ic_secret_token):
-        try:
-            r = session.request(method, 'https://api.intercom.io' + url, json=data, headers=headers)
-            r.raise_for_status()
-        except Exception as e:
-            logger.exception(e)
-            raise e
-        return r.json()
+        stats = current_run_stats.get()
+        for attempt in range(max_retries + 1):
+            try:
+                r = session.request(method, app_settings.ic_api_url + url, json=data, headers=headers)
+                if stats:
+                    stats.api_calls += 1
+                if r.status_code == 429 and attempt < max_retries:
+                    wait = rate_limit_wait(r)
+                    logger.warning('Rate limited by Intercom, retrying %s %s in %.1fs', method, url, wait)
+                    if stats:
+                        stats.retries += 1
+                        stats.rate_limit_wait += wait
+                    time.sleep(wait)
+                    continue
+                r.raise_for_status()
+            except Exception as e:
+                logger.exception(e)
+                raise e
+            return r.json(object_hook=object_hook) if object_hook else r.json()
 
 
 async def async_intercom_request(url: str, data: Optional[dict] = None, method: str = 'GET') -> Optional[dict]:
@@ -96,9 +131,21 @@ async def handle_blog_callback(request: Request) -> JSONResponse:
     logfire.info('Blog callback', data=data)
     data_to_send = {'role': 'user', 'email': data['email'], 'custom_attributes': {'blog-subscribe': True}}
     if r.get('data'):
-        await async_intercom_request(url=f'/contacts/{r["data"][0]["id"]}', data=data_to_send, method='PUT')
+        contact_id = r['data'][0]['id']
+        if app_settings.contact_write_queue:
+            await enqueue_contact_update(request.app.redis, str(contact_id), data_to_send)
+        else:
+            await async_intercom_request(url=f'/contacts/{contact_id}', data=data_to_send, method='PUT')
         msg = 'Blog subscription added to existing user'
     else:
         await async_intercom_request(url='/contacts', data=data_to_send, method='POST')
         msg = 'Blog subscription added to a new user'
     return JSONResponse({'message': msg})
+
+
+async def handle_duplicate_job_runs(request: Request, limit: int) -> JSONResponse:
+    """
+    Returns the timings and counts of the most recent duplicate job runs, most recent first.
+    """
+    limit = min(max(limit, 1), app_settings.duplicate_job_history)
+    return JSONResponse({'runs': await get_runs(request.app.redis, limit)})
@@ -0,0 +1,21 @@
+from arq import cron, func
+
+from tcintercom.app.logs import logfire_setup
+from tcintercom.app.partitioned import dedupe_partition_job
+from tcintercom.app.settings import app_settings
+from tcintercom.app.write_queue import sweep_contact_updates, write_contact_update
+
+
+async def startup(ctx):
+    logfire_setup('worker')
+
+
+class WorkerSettings:
+    functions = [
+        func(write_contact_update, keep_result=0),
+        func(dedupe_partition_job, timeout=app_settings.duplicate_job_partition_timeout),
+    ]
+    cron_jobs = [cron(sweep_contact_updates, run_at_startup=True)]
+    redis_settings = app_settings.redis_settings
+    max_jobs = app_settings.contact_write_concurrency
+    on_startup = startup
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+
+import logfire
+from arq import create_pool
+from arq.connections import ArqRedis
+
+from tcintercom.app.settings import app_settings
+
+logger = logging.getLogger('tc-intercom.write_queue')
+
+PATCH_KEY = 'ic-contact-patch:'
+JOB_ID = 'ic-contact-write:'
+# seconds a write job waits for updates merged as it was finishing before it ends
+FINAL_CHECK_DELAY = 0.5
+
+# Merges a patch into the pending patch for a contact. Top level fields in the newer patch replace the older ones,
+# except custom_attributes which are merged. With ARGV[2] == 'under' the pending patch is treated as the newer one,
+# this is used to put back a patch that failed to be written without losing updates that arrived in the meantime.
+MERGE_PATCH = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+  redis.call('SET', KEYS[1], ARGV[1])
+  return
+end
+local older, newer = cjson.decode(current), cjson.decode(ARGV[1])
+if ARGV[2] == 'under' then
+  older, newer = newer, older
+end
+for k, v in pairs(newer) do
+  if k == 'custom_attributes' and type(v) == 'table' and type(older[k]) == 'table' then
+    for ck, cv in pairs(v) do
+      older[k][ck] = cv
+    end
+  else
+    older[k] = v
+  end
+end
+redis.call('SET', KEYS[1], cjson.encode(older))
+"""
+
+
+async def enqueue_contact_update(redis: ArqRedis, contact_id: str, data: dict):
+    """
+    Merges data into the pending update for the contact and queues a job to write it. Only one job is queued per
+    contact at a time, so every update made before the job runs is sent to Intercom in a single PUT.
+    """
+    await redis.eval(MERGE_PATCH, 1, PATCH_KEY + contact_id, json.dumps(data), 'over')
+    await redis.enqueue_job(
+        'write_contact_update', contact_id, _job_id=JOB_ID + contact_id, _defer_by=app_settings.contact_write_delay
+    )
+
+
+async def enqueue_contact_updates(updates: list[tuple[str, dict]]):
+    """
+    Queues updates to many contacts from outside the web app (eg. the cron job).
+    """
+    redis = await create_pool(app_settings.redis_settings)
+    try:
+        for contact_id, data in updates:
+            await enqueue_contact_update(redis, contact_id, data)
+    finally:
+        await redis.aclose()
+
+
+def _retryable(exc: Exception) -> bool:
+    """
+    Whether a failed write is worth retrying: rate limits, errors on Intercom's side and transport errors. Any other
+    4xx means Intercom rejected the update itself (eg. the contact was deleted or the email is invalid).
+    """
+    response = getattr(exc, 'response', None)
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+
+async def write_contact_update(ctx, contact_id: str) -> int:
+    """
+    Job which writes the pending update for a contact to Intercom. Keeps going until there are no more pending
+    updates as any queued while this job is running won't get a job of their own. Once there are none it checks again
+    after FINAL_CHECK_DELAY, so an update merged just as the job was finishing doesn't wait for the sweep.
+    """
+    from .views import intercom_request
+
+    redis: ArqRedis = ctx['redis']
+    key = PATCH_KEY + contact_id
+    writes = 0
+    while True:
+        if not (data := await redis.getdel(key)):
+            await asyncio.sleep(FINAL_CHECK_DELAY)
+            if not (data := await redis.getdel(key)):
+                return writes
+        try:
+            await asyncio.to_thread(
+                intercom_request, f'/contacts/{contact_id}', json.loads(data), 'PUT', app_settings.ic_max_retries
+            )
+        except Exception as e:
+            if not _retryable(e):
+                logfire.warn(
+                    'Dropping update to contact {contact_id}, rejected by Intercom with {status}',
+                    contact_id=contact_id,
+                    status=e.response.status_code,
+                    data=json.loads(data),
+                )
+                continue
+            # put the update back for sweep_contact_updates to retry
+            await redis.eval(MERGE_PATCH, 1, key, data, 'under')
+            raise
+        writes += 1
+
+
+async def sweep_contact_updates(ctx):
+    """
+    Cron job which queues jobs for any pending updates without one, eg. if an update was merged just as the contact's
+    job was finishing or the write failed.
+    """
+    redis: ArqRedis = ctx['redis']
+    queued = 0
+    async for key in redis.scan_iter(match=PATCH_KEY + '*'):
+        contact_id = key.decode().removeprefix(PATCH_KEY)
+        if await redis.enqueue_job('write_contact_update', contact_id, _job_id=JOB_ID + contact_id):
+            queued += 1
+    if queued:
+        logfire.info('Queued {queued} pending contact updates', queued=queued)
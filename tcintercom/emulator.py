@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from tcintercom.app._mark_duplicate import MAX_PAGE_SIZE
+
+logger = logging.getLogger('tc-intercom.emulator')
+
+
+def sign_payload(payload: bytes, secret: str) -> str:
+    """
+    Signs a webhook body the same way Intercom does, see validate_ic_webhook_signature.
+    """
+    return f'sha1={hmac.new(secret.encode(), payload, hashlib.sha1).hexdigest()}'
+
+
+def _error(status_code: int, code: str, message: str, headers: Optional[dict] = None) -> JSONResponse:
+    return JSONResponse(
+        {'type': 'error.list', 'errors': [{'code': code, 'message': message}]}, status_code=status_code, headers=headers
+    )
+
+
+def _matches(contact: dict, query: dict) -> bool:
+    """
+    Checks a contact against a search query, supporting = and != on (dotted) fields, combined with AND and OR.
+    """
+    if query['operator'] in ('AND', 'OR'):
+        results = (_matches(contact, q) for q in query['value'])
+        return all(results) if query['operator'] == 'AND' else any(results)
+    value = contact
+    for key in query['field'].split('.'):
+        value = (value or {}).get(key)
+    if query['operator'] == '=':
+        return value == query['value']
+    elif query['operator'] == '!=':
+        return value != query['value']
+    raise ValueError(f'Unsupported operator {query["operator"]}')
+
+
+class IntercomEmulator:
+    """
+    An in memory emulator of the Intercom endpoints we use, for testing offline:
+
+    - GET /contacts lists contacts, most recently seen first, with cursor pagination. The cursor is the id of the last
+      contact on the page.
+    - POST /contacts/search finds contacts with simple queries like the one used by the blog callback.
+    - PUT /contacts/{id} updates a contact and POST /contacts creates one.
+
+    Requests need the token when it's set. Every response has Intercom's rate limit headers and requests are rate
+    limited to rate_limit per rate_limit_window seconds (Intercom's default for private apps), returning a 429 once
+    it's used up. Every response is delayed by latency seconds, error_rate of requests fail with a 500 and fail_next()
+    fails specific requests. Requests made are kept in requests as (method, path, status code).
+    """
+
+    def __init__(
+        self,
+        token: str = '',
+        latency: float = 0,
+        rate_limit: int = 1666,
+        rate_limit_window: int = 10,
+        error_rate: float = 0,
+        webhook_secret: str = '',
+    ):
+        self.token = token
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.error_rate = error_rate
+        self.webhook_secret = webhook_secret
+        self.contacts: dict[str, dict] = {}
+        self.requests: list[tuple[str, str, int]] = []
+        self._faults: list[tuple[Optional[str], int]] = []
+        self._ids = itertools.count(1)
+        self._window = 0
+        self._window_requests = 0
+        self.app = self._create_app()
+
+    def add_contact(self, email: Optional[str] = None, **fields) -> dict:
+        """
+        Adds a contact, fields override the defaults which are shaped like a contact returned by Intercom.
+        """
+        contact_id = f'{next(self._ids):024x}'
+        now = int(time.time())
+        contact = {
+            'type': 'contact',
+            'id': contact_id,
+            'workspace_id': 'emulator',
+            'external_id': None,
+            'role': 'user',
+            'email': email,
+            'name': None,
+            'phone': None,
+            'created_at': now,
+            'updated_at': now,
+            'last_seen_at': None,
+            'location': {'type': 'location', 'country': None, 'region': None, 'city': None},
+            'tags': {'type': 'list', 'data': [], 'url': f'/contacts/{contact_id}/tags', 'total_count': 0},
+            'companies': {'type': 'list', 'data': [], 'url': f'/contacts/{contact_id}/companies', 'total_count': 0},
+            'custom_attributes': {},
+            **fields,
+        }
+        self.contacts[contact_id] = contact
+        return contact
+
+    def seed_contacts(self, count: int, duplicate_ratio: float = 0.1, active_days: int = 120):
+        """
+        Adds count contacts last seen over the last active_days days, with duplicate_ratio of them sharing an email
+        with an earlier contact.
+        """
+        now = int(time.time())
+        for n in range(count):
+            email_n = random.randrange(n) if n and random.random() < duplicate_ratio else n
+            self.add_contact(
+                email=f'contact_{email_n}@example.com',
+                created_at=now - random.randrange(365 * 86400),
+                last_seen_at=now - random.randrange(active_days * 86400),
+            )
+
+    def fail_next(self, status_code: int = 500, count: int = 1, path: Optional[str] = None):
+        """
+        Fails the next count requests, or the next count requests to urls starting with path, with status_code.
+        """
+        self._faults += [(path, status_code)] * count
+
+    def notification(self, topic: str, item: dict) -> dict:
+        """
+        A notification_event like the ones Intercom sends to webhooks.
+        """
+        return {
+            'type': 'notification_event',
+            'app_id': 'emulator',
+            'topic': topic,
+            'id': f'notif_{next(self._ids)}',
+            'created_at': int(time.time()),
+            'data': {'type': 'notification_event_data', 'item': item},
+        }
+
+    def send_webhook(self, url: str, topic: str, item: dict, client=httpx):
+        """
+        Sends a notification to url signed with webhook_secret, client can be anything with httpx's post(), eg. a
+        TestClient.
+        """
+        body = json.dumps(self.notification(topic, item)).encode()
+        headers = {'Content-Type': 'application/json', 'X-Hub-Signature': sign_payload(body, self.webhook_secret)}
+        return client.post(url, content=body, headers=headers)
+
+    def _rate_limit_headers(self) -> dict:
+        window = int(time.time()) // self.rate_limit_window * self.rate_limit_window
+        if window != self._window:
+            self._window, self._window_requests = window, 0
+        self._window_requests += 1
+        return {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(max(self.rate_limit - self._window_requests, 0)),
+            'X-RateLimit-Reset': str(window + self.rate_limit_window),
+        }
+
+    def _take_fault(self, path: str) -> Optional[int]:
+        for i, (fault_path, status_code) in enumerate(self._faults):
+            if fault_path is None or path.startswith(fault_path):
+                del self._faults[i]
+                return status_code
+        if self.error_rate and random.random() < self.error_rate:
+            return 500
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.middleware('http')
+        async def emulate(request: Request, call_next):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            headers = self._rate_limit_headers()
+            if self._window_requests > self.rate_limit:
+                response = _error(429, 'rate_limit_exceeded', 'Exceeded rate limit', headers)
+            elif status_code := self._take_fault(request.url.path):
+                response = _error(status_code, 'server_error', 'Injected fault', headers)
+            elif self.token and request.headers.get('Authorization') != f'Bearer {self.token}':
+                response = _error(401, 'unauthorized', 'Access Token Invalid', headers)
+            else:
+                response = await call_next(request)
+                response.headers.update(headers)
+            self.requests.append((request.method, request.url.path, response.status_code))
+            return response
+
+        @app.get('/contacts')
+        async def list_contacts(per_page: int = 50, starting_after: Optional[str] = None):
+            per_page = min(max(per_page, 1), MAX_PAGE_SIZE)
+            contacts = sorted(self.contacts.values(), key=lambda c: c.get('last_seen_at') or 0, reverse=True)
+            start = 0
+            if starting_after:
+                ids = [c['id'] for c in contacts]
+                if starting_after not in ids:
+                    return _error(400, 'parameter_invalid', 'starting_after is invalid')
+                start = ids.index(starting_after) + 1
+            data = contacts[start : start + per_page]
+            pages = {
+                'type': 'pages',
+                'page': start // per_page + 1,
+                'per_page': per_page,
+                'total_pages': -(-len(contacts) // per_page),
+            }
+            if start + per_page < len(contacts):
+                pages['next'] = {'page': pages['page'] + 1, 'starting_after': data[-1]['id']}
+            return {'type': 'list', 'data': data, 'total_count': len(contacts), 'pages': pages}
+
+        @app.post('/contacts/search')
+        async def search_contacts(request: Request):
+            body = await request.json()
+            per_page = min((body.get('pagination') or {}).get('per_page', 50), MAX_PAGE_SIZE)
+            try:
+                found = [c for c in self.contacts.values() if _matches(c, body['query'])]
+            except (KeyError, TypeError, ValueError) as e:
+                return _error(400, 'parameter_invalid', f'Invalid query: {e}')
+            return {
+                'type': 'list',
+                'data': found[:per_page],
+                'total_count': len(found),
+                'pages': {'type': 'pages', 'page': 1, 'per_page': per_page, 'total_pages': 1},
+            }
+
+        @app.put('/contacts/{contact_id}')
+        async def update_contact(contact_id: str, request: Request):
+            if not (contact := self.contacts.get(contact_id)):
+                return _error(404, 'not_found', 'User Not Found')
+            data = await request.json()
+            custom_attributes = {**contact['custom_attributes'], **data.pop('custom_attributes', {})}
+            contact.update(data, custom_attributes=custom_attributes, updated_at=int(time.time()))
+            return contact
+
+        @app.post('/contacts')
+        async def create_contact(request: Request):
+            return self.add_contact(**await request.json())
+
+        return app
+
+
+class EmulatorServer:
+    """
+    Serves an emulator with uvicorn in a background thread, as a context manager returning its url.
+    """
+
+    def __init__(self, emulator: IntercomEmulator, host: str = '127.0.0.1', port: int = 0):
+        self.emulator = emulator
+        self.server = uvicorn.Server(uvicorn.Config(emulator.app, host=host, port=port, log_level='warning'))
+        self._thread = threading.Thread(target=self.server.run, name='intercom-emulator', daemon=True)
+
+    def __enter__(self) -> str:
+        self._thread.start()
+        end = time.monotonic() + 10
+        while not self.server.started:
+            if not self._thread.is_alive() or time.monotonic() > end:
+                raise RuntimeError('Intercom emulator did not start')
+            time.sleep(0.01)
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        return f'http://{host}:{port}'
+
+    def __exit__(self, *args):
+        self.server.should_exit = True
+        self._thread.join()
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(prog='run.py emulator', description='Run the Intercom emulator')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--contacts', type=int, default=1000, help='number of contacts to seed')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help='fraction of seeded contacts to duplicate')
+    parser.add_argument('--token', default='', help='access token requests must use, any token when empty')
+    parser.add_argument('--webhook-secret', default='', help='secret used to sign webhooks')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to delay every response by')
+    parser.add_argument('--rate-limit', type=int, default=1666, help='requests allowed per rate limit window')
+    parser.add_argument('--rate-limit-window', type=int, default=10, help='seconds in each rate limit window')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests to fail with a 500')
+    args = parser.parse_args(argv)
+    emulator = IntercomEmulator(
+        token=args.token,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+        error_rate=args.error_rate,
+        webhook_secret=args.webhook_secret,
+    )
+    emulator.seed_contacts(args.contacts, args.duplicate_ratio)
+    logger.info('Intercom emulator with %d contacts on port %d', len(emulator.contacts), args.port)
+    uvicorn.run(emulator.app, host='127.0.0.1', port=args.port, log_level='warning')
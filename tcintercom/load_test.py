@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import random
+import socket
+import time
+from collections import Counter
+
+import httpx
+import uvicorn
+
+from tcintercom.app.loop_monitor import LoopLagProbe, percentile
+from tcintercom.app.main import create_app
+from tcintercom.app.settings import app_settings
+from tcintercom.emulator import IntercomEmulator, sign_payload
+
+logger = logging.getLogger('tc-intercom.load_test')
+
+LOAD_TEST_SECRET = 'load-test-secret'
+
+
+def intercom_webhook_payload(n: int) -> dict:
+    """
+    A notification_event similar to the ones Intercom sends to /callback/.
+    """
+    return {
+        'type': 'notification_event',
+        'app_id': 'load-test',
+        'topic': random.choice(['conversation.user.created', 'conversation.user.replied', 'contact.user.created']),
+        'id': f'notif_{n}',
+        'created_at': int(time.time()),
+        'data': {
+            'type': 'notification_event_data',
+            'item': {
+                'type': 'conversation',
+                'id': str(n),
+                'user': {'type': 'user', 'id': f'user_{n}', 'email': f'user_{n}@example.com'},
+            },
+        },
+    }
+
+
+def blog_payload(n: int) -> dict:
+    """
+    A form submission similar to the ones Netlify sends to /blog-callback/.
+    """
+    return {'email': f'reader_{n % 500}@example.com', 'form_name': 'blog-subscribe'}
+
+
+def fake_intercom(latency: float) -> IntercomEmulator:
+    """
+    An Intercom emulator for the webhooks to hit, with about half of the blog subscribers already in Intercom.
+    """
+    emulator = IntercomEmulator(token=LOAD_TEST_SECRET, latency=latency)
+    for n in range(1, 500, 2):
+        emulator.add_contact(email=f'reader_{n}@example.com')
+    return emulator
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _serve_fake_intercom(port: int, latency: float):
+    uvicorn.run(fake_intercom(latency).app, host='127.0.0.1', port=port, log_level='warning')
+
+
+def _serve_app(port: int, ic_api_url: str, stop: multiprocessing.Event, results: multiprocessing.Queue):
+    """
+    Runs create_app() pointed at the fake Intercom, measuring the event loop lag until stop is set.
+    """
+    app_settings.ic_api_url = ic_api_url
+    app_settings.ic_secret_token = LOAD_TEST_SECRET
+    app_settings.ic_client_secret = LOAD_TEST_SECRET
+    # per request logging would swamp the report
+    logging.getLogger('tc-intercom').setLevel(logging.WARNING)
+    probe = LoopLagProbe()
+    server = uvicorn.Server(uvicorn.Config(create_app(), host='127.0.0.1', port=port, log_level='warning'))
+
+    async def wait_for_stop():
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        server.should_exit = True
+
+    async def serve():
+        probe_task = asyncio.create_task(probe.run())
+        stop_task = asyncio.create_task(wait_for_stop())
+        await server.serve()
+        probe_task.cancel()
+        stop_task.cancel()
+
+    asyncio.run(serve())
+    results.put(probe.summary())
+
+
+async def _wait_until_up(url: str, timeout: float = 10):
+    async with httpx.AsyncClient() as client:
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f'{url} did not start within {timeout}s')
+
+
+async def generate_load(
+    base_url: str, rate: float, concurrency: int, duration: float, blog_ratio: float, secret: str
+) -> dict:
+    """
+    Sends requests to the webhook endpoints at a fixed rate (open loop) with at most concurrency in flight, returning
+    the latencies and status counts.
+    """
+    latencies, statuses = [], Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+
+        async def send(n: int):
+            async with semaphore:
+                if random.random() < blog_ratio:
+                    url, body = '/blog-callback/', json.dumps(blog_payload(n)).encode()
+                else:
+                    url, body = '/callback/', json.dumps(intercom_webhook_payload(n)).encode()
+                headers = {'Content-Type': 'application/json', 'X-Hub-Signature': sign_payload(body, secret)}
+                start = time.perf_counter()
+                try:
+                    r = await client.post(url, content=body, headers=headers)
+                    statuses[r.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - start)
+
+        tasks = []
+        start = time.perf_counter()
+        total = int(rate * duration)
+        for n in range(total):
+            delay = start + n / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(n)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return {'latencies': latencies, 'statuses': statuses, 'elapsed': elapsed}
+
+
+def build_report(result: dict, loop_lag: dict) -> dict:
+    latencies, statuses = result['latencies'], result['statuses']
+    total = sum(statuses.values())
+    errors = sum(v for k, v in statuses.items() if not (isinstance(k, int) and k < 400))
+    return {
+        'requests': total,
+        'rps': total / result['elapsed'] if result['elapsed'] else 0.0,
+        'error_rate': errors / total if total else 0.0,
+        'statuses': dict(statuses),
+        'latency_ms': {p: percentile(latencies, p) * 1000 for p in (50, 90, 95, 99, 100)},
+        'loop_lag_ms': {k: v * 1000 if k != 'samples' else v for k, v in loop_lag.items()},
+    }
+
+
+def run_load_test(
+    rate: float = 50, concurrency: int = 20, duration: float = 10, blog_ratio: float = 0.5, ic_latency: float = 0.05
+) -> dict:
+    """
+    Starts the app and an Intercom emulator in separate processes, replays signed webhooks against the app and returns
+    the report. The app's lifespan still connects to Redis at redis_url.
+    """
+    app_port, ic_port = _free_port(), _free_port()
+    app_url, ic_url = f'http://127.0.0.1:{app_port}', f'http://127.0.0.1:{ic_port}'
+    stop, results = multiprocessing.Event(), multiprocessing.Queue()
+    fake_ic = multiprocessing.Process(target=_serve_fake_intercom, args=(ic_port, ic_latency), daemon=True)
+    app = multiprocessing.Process(target=_serve_app, args=(app_port, ic_url, stop, results), daemon=True)
+    fake_ic.start()
+    app.start()
+    try:
+        asyncio.run(_wait_until_up(ic_url))
+        asyncio.run(_wait_until_up(app_url))
+        result = asyncio.run(generate_load(app_url, rate, concurrency, duration, blog_ratio, LOAD_TEST_SECRET))
+        stop.set()
+        loop_lag = results.get(timeout=30)
+    finally:
+        app.terminate()
+        fake_ic.terminate()
+        app.join()
+        fake_ic.join()
+    return build_report(result, loop_lag)
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(prog='run.py loadtest', description='Load test the webhook endpoints')
+    parser.add_argument('--rate', type=float, default=50, help='requests per second to send')
+    parser.add_argument('--concurrency', type=int, default=20, help='maximum requests in flight')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to send requests for')
+    parser.add_argument('--blog-ratio', type=float, default=0.5, help='fraction of requests sent to /blog-callback/')
+    parser.add_argument('--ic-latency', type=float, default=0.05, help='seconds the Intercom emulator takes to respond')
+    args = parser.parse_args(argv)
+    report = run_load_test(args.rate, args.concurrency, args.duration, args.blog_ratio, args.ic_latency)
+    print(json.dumps(report, indent=2))
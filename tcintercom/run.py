@@ -21,10 +21,48 @@ def web():
     uvicorn.run(create_app(), host='0.0.0.0', port=port)
 
 
+def worker():
+    from arq import run_worker
+
+    from tcintercom.app.worker import WorkerSettings
+
+    setup_logging()
+    run_worker(WorkerSettings)
+
+
+def loadtest():
+    from tcintercom.load_test import main as load_test_main
+
+    setup_logging()
+    load_test_main(sys.argv[2:])
+
+
+def snapshot():
+    from tcintercom.app.snapshot import main as snapshot_main
+
+    setup_logging()
+    snapshot_main(sys.argv[2:])
+
+
+def emulator():
+    from tcintercom.emulator import main as emulator_main
+
+    setup_logging()
+    emulator_main(sys.argv[2:])
+
+
 def main():
     command = sys.argv[1]
     if command == 'web':
         web()
+    elif command == 'worker':
+        worker()
+    elif command == 'loadtest':
+        loadtest()
+    elif command == 'snapshot':
+        snapshot()
+    elif command == 'emulator':
+        emulator()
     else:
         logger.error(f'Invalid command {command}')
 
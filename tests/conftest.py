@@ -1,9 +1,23 @@
+from unittest import mock
+
 import pytest
 
 from tcintercom.app.settings import app_settings
+from tcintercom.emulator import EmulatorServer, IntercomEmulator
 
 
 @pytest.fixture(scope='module', autouse=True)
 def initialize_tests(request):
     app_settings.testing = True
     return app_settings
+
+
+@pytest.fixture
+def intercom_emulator():
+    """
+    An Intercom emulator served over HTTP, with the app pointed at it.
+    """
+    emulator = IntercomEmulator(token='emulator-token', webhook_secret='emulator-secret')
+    with EmulatorServer(emulator) as url:
+        with mock.patch.multiple(app_settings, ic_api_url=url, ic_secret_token=emulator.token):
+            yield emulator
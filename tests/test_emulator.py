@@ -0,0 +1,107 @@
+import time
+from unittest import mock
+
+import pytest
+from fastapi.testclient import TestClient
+from requests import HTTPError
+
+from tcintercom.app._mark_duplicate import list_all_contacts
+from tcintercom.app.cron_job import update_duplicate_contacts
+from tcintercom.app.main import create_app
+from tcintercom.app.run_stats import RunStats, current_run_stats
+from tcintercom.app.settings import app_settings
+from tcintercom.app.views import intercom_request
+
+
+class TestIntercomEmulator:
+    """
+    Tests the app against the Intercom emulator, over HTTP.
+    """
+
+    def test_contacts_paginated(self, intercom_emulator):
+        """
+        Tests listing contacts follows the cursors until it reaches contacts that haven't been active recently.
+        """
+        now = int(time.time())
+        for n in range(320):
+            intercom_emulator.add_contact(email=f'{n}@example.com', last_seen_at=now - n)
+        for n in range(400):
+            intercom_emulator.add_contact(email=f'old_{n}@example.com', last_seen_at=now - 100 * 86400)
+
+        contacts = list_all_contacts()
+        # the crawl stops after the first page starting with an old contact, without fetching the last page
+        assert len(contacts) == 600
+        assert [c['email'] for c in contacts[:320]] == [f'{n}@example.com' for n in range(320)]
+        assert set(contacts[0]) == {'id', 'email', 'role', 'created_at', 'last_seen_at', 'custom_attributes'}
+        assert [r[:2] for r in intercom_emulator.requests] == [('GET', '/contacts')] * 4
+
+    def test_duplicates_marked(self, intercom_emulator):
+        """
+        Tests the duplicate job marks the older contact sharing an email as a duplicate.
+        """
+        now = int(time.time())
+        keep = intercom_emulator.add_contact(email='a@example.com', created_at=now - 100, last_seen_at=now - 10)
+        duplicate = intercom_emulator.add_contact(email='A@example.com', created_at=now - 200, last_seen_at=now - 20)
+        other = intercom_emulator.add_contact(email='b@example.com', last_seen_at=now - 30)
+
+        update_duplicate_contacts()
+        assert duplicate['custom_attributes'] == {'is_duplicate': True}
+        assert keep['custom_attributes'] == {'is_duplicate': False}
+        assert other['custom_attributes'] == {'is_duplicate': False}
+
+    def test_rate_limit_retried(self, intercom_emulator):
+        """
+        Tests requests rate limited by Intercom are retried once the rate limit resets.
+        """
+        intercom_emulator.rate_limit = 2
+        intercom_emulator.rate_limit_window = 1
+        stats = RunStats()
+        token = current_run_stats.set(stats)
+        try:
+            for _ in range(3):
+                intercom_request('/contacts', max_retries=3)
+        finally:
+            current_run_stats.reset(token)
+
+        assert [r[2] for r in intercom_emulator.requests].count(429) >= 1
+        assert stats.retries == [r[2] for r in intercom_emulator.requests].count(429)
+        assert stats.api_calls == len(intercom_emulator.requests)
+
+    def test_faults(self, intercom_emulator):
+        """
+        Tests injected faults fail the request without retrying and only when they match.
+        """
+        intercom_emulator.fail_next(503, path='/contacts/search')
+        intercom_request('/contacts')
+        with pytest.raises(HTTPError):
+            intercom_request('/contacts/search', {'query': {'field': 'email', 'operator': '=', 'value': 'a'}}, 'POST')
+        intercom_request('/contacts/search', {'query': {'field': 'email', 'operator': '=', 'value': 'a'}}, 'POST')
+        assert [r[2] for r in intercom_emulator.requests] == [200, 503, 200]
+
+    def test_blog_callback(self, intercom_emulator):
+        """
+        Tests the blog callback updates an existing contact and creates one for a new email.
+        """
+        contact = intercom_emulator.add_contact(email='reader@example.com')
+        client = TestClient(create_app())
+
+        r = client.post('/blog-callback/', json={'email': 'reader@example.com'})
+        assert r.json() == {'message': 'Blog subscription added to existing user'}
+        assert contact['custom_attributes'] == {'blog-subscribe': True}
+
+        r = client.post('/blog-callback/', json={'email': 'new@example.com'})
+        assert r.json() == {'message': 'Blog subscription added to a new user'}
+        assert [c['email'] for c in intercom_emulator.contacts.values()] == ['reader@example.com', 'new@example.com']
+
+    def test_signed_webhook(self, intercom_emulator):
+        """
+        Tests webhooks sent by the emulator are accepted by the callback and a bad signature is rejected.
+        """
+        client = TestClient(create_app(), raise_server_exceptions=False)
+        with mock.patch.multiple(app_settings, testing=False, ic_client_secret=intercom_emulator.webhook_secret):
+            r = intercom_emulator.send_webhook('/callback/', 'contact.user.created', {'type': 'contact'}, client)
+            assert r.json() == {'message': 'No action required'}
+
+            intercom_emulator.webhook_secret = 'wrong'
+            r = intercom_emulator.send_webhook('/callback/', 'contact.user.created', {'type': 'contact'}, client)
+            assert r.status_code == 500
@@ -0,0 +1,105 @@
+import threading
+import time
+from unittest import TestCase, mock
+
+from redis import Redis
+
+from tcintercom.app.job_lock import JobLock, LockLost
+from tcintercom.app.settings import app_settings
+
+
+class JobLockTestCase(TestCase):
+    def setUp(self):
+        self.redis = Redis.from_url(app_settings.redis_url)
+        self.redis.delete('test-job:lock', 'test-job:fence', 'test-job:progress')
+
+    def tearDown(self):
+        self.redis.delete('test-job:lock', 'test-job:fence', 'test-job:progress')
+        self.redis.close()
+
+    def test_one_run_at_a_time(self):
+        """
+        Tests only one run can hold the lock and that each run gets a higher fencing token.
+        """
+        lock = JobLock(self.redis, 'test-job', ttl=10)
+        assert lock.acquire()
+        assert lock.token == 1
+        lock.set_progress(phase='fetching', contacts=10)
+
+        other = JobLock(self.redis, 'test-job', ttl=10)
+        assert not other.acquire()
+        assert other.get_progress() == {'fence': '1', 'phase': 'fetching', 'contacts': '10', 'started_at': mock.ANY}
+
+        lock.release()
+        assert other.get_progress()['phase'] == 'finished'
+        assert other.acquire()
+        assert other.token == 2
+        other.release()
+
+    def test_heartbeat(self):
+        """
+        Tests the heartbeat keeps the lock past its ttl and that it expires once the heartbeat stops.
+        """
+        lock = JobLock(self.redis, 'test-job', ttl=0.3)
+        assert lock.acquire()
+        time.sleep(0.5)
+        lock.check()
+        assert lock.is_locked()
+
+        lock._stop.set()
+        lock._heartbeat.join()
+        time.sleep(0.5)
+        assert not lock.is_locked()
+        with self.assertRaises(LockLost):
+            lock.check()
+
+    @mock.patch('tcintercom.app.job_lock.logfire.warn')
+    def test_lock_taken_over(self, mock_warn):
+        """
+        Tests that once another run has taken over, the old run's check fails and releasing doesn't remove the new
+        run's lock.
+        """
+        lock = JobLock(self.redis, 'test-job', ttl=0.3)
+        assert lock.acquire()
+        self.redis.set('test-job:lock', 2)
+        with self.assertRaises(LockLost):
+            lock.check()
+        time.sleep(0.2)
+        assert mock_warn.called
+
+        lock.release()
+        assert self.redis.get('test-job:lock') == b'2'
+
+    def test_stale_release(self):
+        """
+        Tests that a run releasing after its lease expired and another run took over leaves the new run's lock and
+        progress alone.
+        """
+        lock = JobLock(self.redis, 'test-job', ttl=0.3)
+        assert lock.acquire()
+        # the run stalls so its heartbeat stops and the lease expires
+        lock._stop.set()
+        lock._heartbeat.join()
+        time.sleep(0.4)
+
+        other = JobLock(self.redis, 'test-job', ttl=10)
+        assert other.acquire()
+        other.set_progress(phase='updating')
+
+        lock.release()
+        assert self.redis.get('test-job:lock') == str(other.token).encode()
+        assert other.get_progress()['phase'] == 'updating'
+        assert self.redis.pttl('test-job:progress') > 0
+        other.release()
+
+    def test_wait(self):
+        """
+        Tests waiting for another run returns its final progress once it finishes.
+        """
+        lock = JobLock(self.redis, 'test-job', ttl=10)
+        assert lock.acquire()
+        threading.Timer(0.2, lock.release).start()
+
+        other = JobLock(self.redis, 'test-job', ttl=10)
+        assert not other.acquire()
+        assert other.wait(poll=0.05)['phase'] == 'finished'
@@ -0,0 +1,70 @@
+import json
+from collections import Counter
+from unittest import TestCase, mock
+
+from fastapi.testclient import TestClient
+
+from tcintercom.app.main import create_app
+from tcintercom.load_test import (
+    LOAD_TEST_SECRET,
+    blog_payload,
+    build_report,
+    fake_intercom,
+    intercom_webhook_payload,
+    percentile,
+    sign_payload,
+)
+
+
+class LoadTestTestCase(TestCase):
+    def test_percentile(self):
+        """
+        Tests the interpolated percentiles used in the load test report.
+        """
+        assert percentile([], 50) == 0
+        assert percentile([3, 1, 2], 50) == 2
+        assert percentile([1, 2, 3, 4], 50) == 2.5
+        assert percentile([1, 2, 3, 4], 100) == 4
+
+    @mock.patch('tcintercom.app.settings.app_settings.testing', False)
+    @mock.patch('tcintercom.app.settings.app_settings.ic_client_secret', 'TESTKEY')
+    def test_signed_payload_accepted(self):
+        """
+        Tests that the replayed webhooks are signed in a way the callback endpoint accepts.
+        """
+        client = TestClient(create_app())
+        body = json.dumps(intercom_webhook_payload(1)).encode()
+        r = client.post('/callback/', content=body, headers={'X-Hub-Signature': sign_payload(body, 'TESTKEY')})
+        assert r.json() == {'message': 'No action required'}
+
+    def test_fake_intercom(self):
+        """
+        Tests the emulated Intercom responds to the requests made by the blog callback.
+        """
+        client = TestClient(fake_intercom(latency=0).app, headers={'Authorization': f'Bearer {LOAD_TEST_SECRET}'})
+        query = {'query': {'field': 'email', 'operator': '=', 'value': blog_payload(1)['email']}}
+        contact_id = client.post('/contacts/search', json=query).json()['data'][0]['id']
+        r = client.put(f'/contacts/{contact_id}', json={'custom_attributes': {'blog-subscribe': True}})
+        assert r.json()['custom_attributes'] == {'blog-subscribe': True}
+
+        email = blog_payload(2)['email']
+        query['query']['value'] = email
+        assert client.post('/contacts/search', json=query).json()['data'] == []
+        r = client.post('/contacts', json={'email': email})
+        assert r.json()['email'] == email
+
+    def test_build_report(self):
+        """
+        Tests the report counts non 2xx responses and transport errors as errors.
+        """
+        result = {
+            'latencies': [0.1, 0.2, 0.3, 0.4],
+            'statuses': Counter({200: 2, 500: 1, 'ReadTimeout': 1}),
+            'elapsed': 2,
+        }
+        report = build_report(result, {'samples': 1, 'mean': 0.01, 'p99': 0.01, 'max': 0.01})
+        assert report['requests'] == 4
+        assert report['rps'] == 2
+        assert report['error_rate'] == 0.5
+        assert report['latency_ms'][100] == 400
+        assert report['loop_lag_ms'] == {'samples': 1, 'mean': 10, 'p99': 10, 'max': 10}
@@ -0,0 +1,100 @@
+import asyncio
+import time
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+
+from fastapi.testclient import TestClient
+
+from tcintercom.app.loop_monitor import LoopMonitor, _TimedCoroutine
+from tcintercom.app.main import create_app
+
+
+def block_loop():
+    time.sleep(0.3)
+
+
+class LoopMonitorTestCase(IsolatedAsyncioTestCase):
+    @mock.patch('tcintercom.app.loop_monitor.logfire.warn')
+    async def test_blocking_callback_reported(self, mock_warn):
+        """
+        Tests that a callback holding the event loop is reported with its stack.
+        """
+        monitor = LoopMonitor(threshold=0.1, interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        block_loop()
+        await asyncio.sleep(0.1)
+        monitor.stop()
+
+        assert mock_warn.call_count == 1
+        assert mock_warn.call_args[1]['blocked_ms'] > 100
+        assert 'block_loop' in mock_warn.call_args[1]['stack']
+
+    @mock.patch('tcintercom.app.loop_monitor.logfire.warn')
+    async def test_no_blocking(self, mock_warn):
+        """
+        Tests that nothing is reported when the loop isn't blocked.
+        """
+        monitor = LoopMonitor(threshold=0.1, interval=0.01)
+        monitor.start()
+        await asyncio.sleep(0.2)
+        monitor.stop()
+        assert not mock_warn.called
+
+    async def test_timed_coroutine(self):
+        """
+        Tests the time a coroutine spends blocking the loop is separated from the time it spends awaiting.
+        """
+
+        async def handler():
+            await asyncio.sleep(0.1)
+            time.sleep(0.1)
+            return 'done'
+
+        timed = _TimedCoroutine(handler())
+        assert await timed == 'done'
+        assert 0.1 <= timed.on_loop < 0.15
+        assert timed.cpu < 0.05
+
+        timed = _TimedCoroutine(asyncio.sleep(1))
+        task = asyncio.ensure_future(timed)
+        await asyncio.sleep(0)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+
+@mock.patch('tcintercom.app.settings.app_settings.loop_monitor', True)
+@mock.patch('tcintercom.app.settings.app_settings.loop_monitor_threshold', 0.05)
+@mock.patch('tcintercom.app.settings.app_settings.ic_secret_token', 'TESTKEY')
+class RequestTimingTestCase(TestCase):
+    @mock.patch('tcintercom.app.loop_monitor.logfire.warn')
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_slow_request_reported(self, mock_request, mock_warn):
+        """
+        Tests that a request blocking the loop on a synchronous Intercom request is reported with its breakdown.
+        """
+
+        def slow_response(*args, **kwargs):
+            time.sleep(0.1)
+            return mock.Mock(json=lambda: {'data': []})
+
+        mock_request.side_effect = slow_response
+        client = TestClient(create_app())
+        r = client.post('/blog-callback/', json={'email': 'test@testing.com'})
+        assert r.status_code == 200
+
+        assert mock_warn.call_count == 1
+        kwargs = mock_warn.call_args[1]
+        assert kwargs['path'] == '/blog-callback/'
+        assert kwargs['blocking_ms'] >= 150
+        assert kwargs['wall_ms'] >= kwargs['blocking_ms'] + kwargs['cpu_ms']
+
+    @mock.patch('tcintercom.app.loop_monitor.logfire.warn')
+    def test_fast_request(self, mock_warn):
+        """
+        Tests that fast requests aren't reported.
+        """
+        client = TestClient(create_app())
+        r = client.get('/')
+        assert r.status_code == 200
+        assert not mock_warn.called
@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import hmac
 import json
@@ -8,11 +9,14 @@ from fastapi.testclient import TestClient
 
 from tcintercom.app.logs import logfire_setup
 from tcintercom.app.main import create_app
+from tcintercom.app.worker import startup
 from tcintercom.run import main
 
 
 def get_mock_response(test):
     class MockResponse:
+        status_code = 200
+
         def __init__(self, method, url, *args, **kwargs):
             self.url = url
             self.return_dict = {
@@ -20,7 +24,7 @@ def get_mock_response(test):
                 'blog_existing_user': {'data': [{'id': 123}]},
             }
 
-        def json(self):
+        def json(self, **kwargs):
             if test in self.return_dict:
                 return self.return_dict[test]
 
@@ -97,6 +101,14 @@ class TCIntercomSetup(TestCase):
         assert mock_sentry.called
         assert mock_sentry.call_count == 1
 
+    @mock.patch('tcintercom.app.worker.logfire_setup')
+    def test_worker_startup(self, mock_logfire_setup):
+        """
+        Tests that logfire is set up when the worker starts.
+        """
+        asyncio.run(startup({}))
+        mock_logfire_setup.assert_called_once_with('worker')
+
     def test_lifespan_setup(self):
         """
         Tests that the lifespan context manager sets up the app correctly. We have to use with TestClient to test
@@ -265,3 +277,21 @@ class BlogCallbackTestCase(TestCase):
         assert r.json() == {'message': 'Blog subscription added to existing user'}
         assert mock_request.call_args_list[-1][0][0] == 'PUT'  # Assert PUT request (updating rather than creating)
         assert mock_request.call_args_list[-1][1]['json']['custom_attributes']['blog-subscribe']
+
+    @mock.patch('tcintercom.app.settings.app_settings.contact_write_queue', True)
+    @mock.patch('tcintercom.app.views.enqueue_contact_update')
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_blog_sub_existing_user_queued(self, mock_request, mock_enqueue):
+        """
+        Tests when the write queue is on, the update to an existing user is queued rather than sent to Intercom.
+        """
+        mock_request.side_effect = get_mock_response('blog_existing_user')
+
+        with TestClient(self.app) as client:
+            r = client.post(self.blog_callback_url, json={'email': 'test@testing.com'})
+        assert r.json() == {'message': 'Blog subscription added to existing user'}
+        assert mock_request.call_count == 1  # only the search
+        assert mock_enqueue.call_args[0][1:] == (
+            '123',
+            {'role': 'user', 'email': 'test@testing.com', 'custom_attributes': {'blog-subscribe': True}},
+        )
@@ -0,0 +1,137 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+
+from arq.constants import default_queue_name, job_key_prefix
+from redis import Redis
+
+from tcintercom.app.cron_job import update_duplicate_contacts
+from tcintercom.app.job_lock import LockLost
+from tcintercom.app.partitioned import (
+    dedupe_partition,
+    dedupe_partition_job,
+    partition_for,
+    run_partitioned,
+    split_partitions,
+)
+from tcintercom.app.run_stats import RUNS_KEY
+from tcintercom.app.settings import app_settings
+from tests.test_workers import TEST_CONTACTS, get_mock_response
+
+
+def thread_pool(workers, mp_context, **kwargs):
+    return ThreadPoolExecutor(workers, **kwargs)
+
+
+class PartitionTestCase(TestCase):
+    def test_partition_for(self):
+        """
+        Tests contacts whose emails normalise to the same value are always in the same partition.
+        """
+        partition = partition_for('test_main@test.com', 8)
+        assert 0 <= partition < 8
+        assert partition_for(' TEST_main@test.com', 8) == partition
+        assert partition_for(None, 8) == 0
+        assert {partition_for(f'{i}@test.com', 4) for i in range(100)} == {0, 1, 2, 3}
+
+    def test_split_partitions(self):
+        """
+        Tests every contact ends up in exactly one partition, trimmed to the fields needed.
+        """
+        contacts = [{**c, 'location': {'city': 'London'}} for c in TEST_CONTACTS.values()]
+        split = split_partitions(contacts, 3)
+        assert len(split) == 3
+        assert [len(p) for p in split if p] == [4]
+        assert all('location' not in c for p in split for c in p)
+
+    def test_run_partitioned_processes(self):
+        """
+        Tests the partitions are deduped in separate processes and their results are added up. The contacts are
+        already marked correctly so no requests are made to Intercom.
+        """
+        contacts = [{**TEST_CONTACTS['main_contact'], 'id': f'c{i}', 'email': f'{i}@test.com'} for i in range(10)]
+        contacts.append({**TEST_CONTACTS['marked_duplicate_contact'], 'email': '1@test.com'})
+        assert run_partitioned(split_partitions(contacts, 2)) == {
+            'duplicates': 1,
+            'not_duplicates': 10,
+            'queued': 0,
+            'updated': 0,
+            'api_calls': 0,
+            'retries': 0,
+            'rate_limit_wait': 0,
+        }
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_dedupe_partition_job(self, mock_request):
+        """
+        Tests the arq job updates the contacts in its partition.
+        """
+        contacts = [TEST_CONTACTS['main_contact'], TEST_CONTACTS['not_marked_duplicate_contact']]
+        result = asyncio.run(dedupe_partition_job({}, 1, contacts))
+        assert result == {
+            'partition': 1,
+            'contacts': 2,
+            'duplicates': 1,
+            'not_duplicates': 1,
+            'updated_duplicate': 1,
+            'updated_not_duplicate': 0,
+            'queued': 0,
+            'api_calls': 1,
+            'retries': 0,
+            'rate_limit_wait': 0,
+        }
+        assert mock_request.call_args[0][1].endswith(TEST_CONTACTS['not_marked_duplicate_contact']['id'])
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_partition_stops_when_lock_lost(self, mock_request):
+        """
+        Tests a partition doesn't update contacts when the coordinator's lock has been taken over.
+        """
+        redis = Redis.from_url(app_settings.redis_url)
+        redis.set('duplicate-job:lock', 2)
+        contacts = [TEST_CONTACTS['main_contact'], TEST_CONTACTS['not_marked_duplicate_contact']]
+        with self.assertRaises(LockLost):
+            dedupe_partition(0, contacts, fence=1)
+        assert not mock_request.called
+        redis.delete('duplicate-job:lock')
+
+    @mock.patch('tcintercom.app.settings.app_settings.duplicate_job_partitions', 3)
+    @mock.patch('tcintercom.app.partitioned.ProcessPoolExecutor', thread_pool)
+    @mock.patch('tcintercom.app.partitioned.logfire_setup')
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_partitioned_job(self, mock_request, mock_logfire_setup):
+        """
+        Tests the cron job marks duplicates when split into partitions, with logfire set up in the workers.
+        """
+        mock_request.side_effect = get_mock_response('more_recently_active_duplicate_contact')
+        update_duplicate_contacts()
+
+        dup_contact = TEST_CONTACTS['not_marked_duplicate_contact']
+        assert mock_request.call_args_list[-1][0][0] == 'PUT'
+        assert mock_request.call_args_list[-1][0][1] == f'https://api.intercom.io/contacts/{dup_contact["id"]}'
+        assert mock_request.call_args_list[-1][1]['json']['custom_attributes']['is_duplicate']
+        mock_logfire_setup.assert_called_with('cron-job')
+
+    @mock.patch('tcintercom.app.settings.app_settings.duplicate_job_partitions', 2)
+    @mock.patch('tcintercom.app.settings.app_settings.duplicate_job_partition_mode', 'arq')
+    @mock.patch('tcintercom.app.settings.app_settings.duplicate_job_partition_timeout', 0.5)
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_arq_partitions_not_picked_up(self, mock_request):
+        """
+        Tests the run fails, releasing its lock, when no worker picks up the partition jobs.
+        """
+        mock_request.side_effect = get_mock_response('more_recently_active_duplicate_contact')
+        redis = Redis.from_url(app_settings.redis_url)
+        queued = set(redis.zrange(default_queue_name, 0, -1))
+        try:
+            with self.assertRaises(TimeoutError):
+                update_duplicate_contacts()
+            assert not redis.exists('duplicate-job:lock')
+            assert json.loads(redis.lindex(RUNS_KEY, 0))['status'] == 'failed'
+            assert mock_request.call_args[0][0] == 'GET'
+        finally:
+            # only remove the partition jobs this run queued
+            if jobs := set(redis.zrange(default_queue_name, 0, -1)) - queued:
+                redis.zrem(default_queue_name, *jobs)
+                redis.delete(*(job_key_prefix + j.decode() for j in jobs))
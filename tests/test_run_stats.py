@@ -0,0 +1,88 @@
+import json
+from unittest import TestCase, mock
+
+from fastapi.testclient import TestClient
+from redis import Redis
+from requests import HTTPError
+
+from tcintercom.app.cron_job import update_duplicate_contacts
+from tcintercom.app.main import create_app
+from tcintercom.app.run_stats import RUNS_KEY, RunStats, current_run_stats, save_run
+from tcintercom.app.settings import app_settings
+from tcintercom.app.views import intercom_request
+from tests.test_workers import get_mock_response
+
+
+def rate_limited_response(reset: str):
+    response = mock.Mock(status_code=429, headers={'X-RateLimit-Reset': reset})
+    response.raise_for_status.side_effect = HTTPError('429 Too Many Requests')
+    return response
+
+
+class RunStatsTestCase(TestCase):
+    def setUp(self):
+        self.redis = Redis.from_url(app_settings.redis_url)
+        self.redis.delete(RUNS_KEY)
+
+    def tearDown(self):
+        self.redis.delete(RUNS_KEY)
+        self.redis.close()
+
+    @mock.patch('tcintercom.app.views.time')
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_rate_limit_retried(self, mock_request, mock_time):
+        """
+        Tests rate limited requests are retried once the rate limit resets and that the retries are counted.
+        """
+        mock_time.time.return_value = 1000
+        ok = mock.Mock(status_code=200, json=lambda: {'data': []})
+        mock_request.side_effect = [rate_limited_response('1003'), rate_limited_response('nonsense'), ok]
+
+        stats = RunStats()
+        token = current_run_stats.set(stats)
+        try:
+            assert intercom_request('/contacts', max_retries=2) == {'data': []}
+        finally:
+            current_run_stats.reset(token)
+        assert [c[0][0] for c in mock_time.sleep.call_args_list] == [3, 1]
+        assert stats.requests() == {'api_calls': 3, 'retries': 2, 'rate_limit_wait': 4}
+
+        mock_request.side_effect = [rate_limited_response('1003'), rate_limited_response('1003')]
+        with self.assertRaises(HTTPError):
+            intercom_request('/contacts', max_retries=1)
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_run_recorded(self, mock_request):
+        """
+        Tests each run of the duplicate job is added to the run history and returned by the endpoint.
+        """
+        mock_request.side_effect = get_mock_response('most_recent_created_at_duplicate_contact')
+        update_duplicate_contacts()
+
+        record = json.loads(self.redis.lindex(RUNS_KEY, 0))
+        assert record['status'] == 'success'
+        assert set(record['phases']) == {'fetch_dedupe', 'update'}
+        assert record['pages'] == 2
+        assert record['contacts'] == 3
+        assert record['updated'] == 1
+        assert record['api_calls'] == 3
+        assert record['peak_rss_mb'] > 0
+
+        mock_request.side_effect = RuntimeError('Intercom is down')
+        with self.assertRaises(RuntimeError):
+            update_duplicate_contacts()
+        assert json.loads(self.redis.lindex(RUNS_KEY, 0))['status'] == 'failed'
+
+        app = create_app()
+        with TestClient(app) as client:
+            r = client.get(app.url_path_for('duplicate-job-runs'), params={'limit': 1})
+        assert r.status_code == 200
+        assert [run['status'] for run in r.json()['runs']] == ['failed']
+
+    def test_history_kept(self):
+        """
+        Tests only the most recent runs are kept.
+        """
+        for i in range(5):
+            save_run(self.redis, {'run': i}, keep=3)
+        assert [json.loads(r)['run'] for r in self.redis.lrange(RUNS_KEY, 0, -1)] == [4, 3, 2]
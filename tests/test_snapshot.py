@@ -0,0 +1,148 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase, mock
+
+from tcintercom.app.snapshot import (
+    SnapshotError,
+    SnapshotWriter,
+    compare_snapshots,
+    dedupe_snapshot,
+    read_snapshot,
+    write_snapshot,
+)
+from tests.test_workers import TEST_CONTACTS, get_mock_response
+
+
+class SnapshotTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / 'contacts.snap'
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_round_trip(self):
+        """
+        Tests contacts read back from a snapshot only have the fields used to find duplicates, with missing values
+        kept as None.
+        """
+        contact = {
+            **TEST_CONTACTS['created_later_contact'],
+            'location': {'city': 'London'},
+            'custom_attributes': {'is_duplicate': False, 'blog-subscribe': True},
+        }
+        no_email = {'id': 'no_email', 'email': None, 'role': 'lead', 'created_at': 1, 'custom_attributes': {}}
+        assert write_snapshot(self.path, [[contact], [], [no_email]]) == 2
+
+        assert list(read_snapshot(self.path)) == [
+            {
+                'id': 'created_later_contact',
+                'email': 'test_main@test.com',
+                'role': 'user',
+                'created_at': contact['created_at'],
+                'last_seen_at': None,
+                'custom_attributes': {'is_duplicate': False},
+            },
+            {
+                'id': 'no_email',
+                'email': None,
+                'role': 'lead',
+                'created_at': 1,
+                'last_seen_at': None,
+                'custom_attributes': {'is_duplicate': None},
+            },
+        ]
+
+    def test_append(self):
+        """
+        Tests writing to an existing snapshot appends to it and that other files are rejected.
+        """
+        write_snapshot(self.path, [[TEST_CONTACTS['main_contact']]])
+        with SnapshotWriter(self.path) as writer:
+            writer.append([TEST_CONTACTS['marked_duplicate_contact']])
+        assert [c['id'] for c in read_snapshot(self.path)] == ['main_contact', 'incorrect_mark_duplicate']
+
+        self.path.write_bytes(b'not a snapshot')
+        with self.assertRaises(SnapshotError):
+            list(read_snapshot(self.path))
+        with self.assertRaises(SnapshotError):
+            write_snapshot(self.path, [[TEST_CONTACTS['main_contact']]], append=True)
+
+    def test_incomplete_chunk(self):
+        """
+        Tests a snapshot cut off part way through a chunk can't be read, and that appending to it removes the
+        incomplete chunk first.
+        """
+        write_snapshot(self.path, [[TEST_CONTACTS['main_contact']], [TEST_CONTACTS['created_later_contact']]])
+        data = self.path.read_bytes()
+        both = ['main_contact', 'created_later_contact', 'incorrect_mark_duplicate']
+        # cut off in the last column, in the next chunk's header and in the next chunk's columns
+        for damaged, ids in ((data[:-3], [both[0], both[2]]), (data + b'CHN', both), (data + data[8:20], both)):
+            self.path.write_bytes(damaged)
+            with self.assertRaises(SnapshotError):
+                list(read_snapshot(self.path))
+
+            write_snapshot(self.path, [[TEST_CONTACTS['marked_duplicate_contact']]], append=True)
+            assert [c['id'] for c in read_snapshot(self.path)] == ids
+
+    def test_corrupt_chunk(self):
+        """
+        Tests a chunk with corrupt data raises a SnapshotError.
+        """
+        write_snapshot(self.path, [[TEST_CONTACTS['main_contact']]])
+        data = bytearray(self.path.read_bytes())
+        data[-4:] = b'\x00' * 4
+        self.path.write_bytes(data)
+        with self.assertRaises(SnapshotError):
+            list(read_snapshot(self.path))
+
+    def test_existing_snapshot(self):
+        """
+        Tests creating a snapshot doesn't add to an existing one unless appending, and that a contact written twice is
+        only counted once, with its last row.
+        """
+        write_snapshot(self.path, [[TEST_CONTACTS['main_contact']]])
+        with self.assertRaises(SnapshotError):
+            write_snapshot(self.path, [[TEST_CONTACTS['main_contact']]])
+
+        marked = {**TEST_CONTACTS['main_contact'], 'custom_attributes': {'is_duplicate': True}}
+        write_snapshot(self.path, [[marked]], append=True)
+        assert len(list(read_snapshot(self.path))) == 2
+        assert dedupe_snapshot(self.path) == {
+            'contacts': 1,
+            'duplicates': 0,
+            'not_duplicates': 1,
+            'mark_duplicate': 0,
+            'mark_not_duplicate': 1,
+        }
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_create_from_intercom(self, mock_request):
+        """
+        Tests the snapshot is created from all the pages of contacts in Intercom.
+        """
+        mock_request.side_effect = get_mock_response('most_recent_created_at_duplicate_contact')
+        assert write_snapshot(self.path) == 3
+        assert mock_request.call_count == 2
+
+    def test_dedupe_and_diff(self):
+        """
+        Tests the duplicate checks run against a snapshot and that snapshots can be compared.
+        """
+        write_snapshot(self.path, [[TEST_CONTACTS['main_contact'], TEST_CONTACTS['not_marked_duplicate_contact']]])
+        assert dedupe_snapshot(self.path) == {
+            'contacts': 2,
+            'duplicates': 1,
+            'not_duplicates': 1,
+            'mark_duplicate': 1,
+            'mark_not_duplicate': 0,
+        }
+
+        new_path = Path(self.tmp_dir.name) / 'new.snap'
+        write_snapshot(new_path, [[TEST_CONTACTS['main_contact'], TEST_CONTACTS['created_later_contact']]])
+        assert compare_snapshots(self.path, new_path) == {
+            'added': 1,
+            'removed': 1,
+            'email_changed': 0,
+            'is_duplicate_changed': 0,
+        }
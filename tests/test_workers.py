@@ -1,9 +1,25 @@
+import json
+import threading
+import time
+import tracemalloc
 from datetime import datetime
-from unittest import mock
+from unittest import TestCase, mock
 
-from requests import RequestException
+from redis import Redis
+from requests import RequestException, Response
 
+from tcintercom.app._mark_duplicate import (
+    get_relevant_accounts,
+    iter_all_contacts,
+    iter_contact_pages,
+    normalise_email,
+    trim_contact_hook,
+)
 from tcintercom.app.cron_job import update_duplicate_contacts
+from tcintercom.app.job_lock import JobLock, LockLost
+from tcintercom.app.run_stats import RunStats, current_run_stats
+from tcintercom.app.settings import app_settings
+from tcintercom.emulator import IntercomEmulator
 
 TEST_CONTACTS = {
     'main_contact': {
@@ -51,6 +67,8 @@ TEST_CONTACTS = {
 
 def get_mock_response(test, error=False):
     class MockResponse:
+        status_code = 200
+
         def __init__(self, method, url, *args, **kwargs):
             self.url = url
             self.return_company = {
@@ -65,7 +83,7 @@ def get_mock_response(test, error=False):
                 'blog_existing_user': {'data': [{'id': 123}]},
             }
 
-        def json(self):
+        def json(self, **kwargs):
             if test == 'duplicate_contacts_basic':
                 if 'contacts?' in self.url:
                     return {'data': [TEST_CONTACTS['main_contact'], TEST_CONTACTS['not_marked_duplicate_contact']]}
@@ -184,3 +202,235 @@ class TestWorkerJobs:
             mock_request.call_args_list[-1][1]['json']['custom_attributes']['is_duplicate']
             != dup_contact['custom_attributes']['is_duplicate']
         )
+
+
+class EmailIndexTestCase(TestCase):
+    def test_normalise_email(self):
+        """
+        Tests emails are stripped and lower cased, with Gmail dots and plus tags only removed with provider rules.
+        """
+        assert normalise_email(' Foo.Bar+blog@GMail.com ') == 'foo.bar+blog@gmail.com'
+        assert normalise_email(' Foo.Bar+blog@GMail.com ', provider_rules=True) == 'foobar@gmail.com'
+        assert normalise_email('foo.bar@googlemail.com', provider_rules=True) == 'foobar@gmail.com'
+        assert normalise_email('foo.bar+blog@x.com', provider_rules=True) == 'foo.bar+blog@x.com'
+        assert normalise_email(None) is None
+        assert normalise_email('  ') is None
+
+    def test_duplicates_with_different_case(self):
+        """
+        Tests contacts whose emails only differ by case or whitespace are duplicates and that contacts without an
+        email are never duplicates.
+        """
+        main_contact = TEST_CONTACTS['main_contact']
+        dup_contact = {**TEST_CONTACTS['not_marked_duplicate_contact'], 'email': ' TEST_main@test.com'}
+        no_email = [{**TEST_CONTACTS['marked_duplicate_contact'], 'id': f'no_email_{i}', 'email': None} for i in (1, 2)]
+
+        with mock.patch('tcintercom.app._mark_duplicate.logfire.info') as mock_info:
+            mark_duplicate, mark_not_duplicate = get_relevant_accounts([main_contact, dup_contact, *no_email])
+        assert mark_duplicate == [dup_contact]
+        assert mark_not_duplicate == [main_contact, *no_email]
+        assert mock_info.call_args[1] == {
+            'unique_emails': 1,
+            'contacts': 4,
+            'missing_email': 2,
+            'hits': 1,
+            'normalised_hits': 1,
+        }
+
+    @mock.patch('tcintercom.app.settings.app_settings.dedupe_email_provider_rules', True)
+    def test_duplicates_with_provider_rules(self):
+        """
+        Tests Gmail addresses differing by dots and plus tags are only duplicates with provider rules.
+        """
+        main_contact = {**TEST_CONTACTS['main_contact'], 'email': 'testmain@gmail.com'}
+        dup_contact = {**TEST_CONTACTS['not_marked_duplicate_contact'], 'email': 'test.main+blog@gmail.com'}
+        mark_duplicate, mark_not_duplicate = get_relevant_accounts([main_contact, dup_contact])
+        assert mark_duplicate == [dup_contact]
+        assert mark_not_duplicate == [main_contact]
+
+        with mock.patch('tcintercom.app.settings.app_settings.dedupe_email_provider_rules', False):
+            mark_duplicate, mark_not_duplicate = get_relevant_accounts([main_contact, dup_contact])
+        assert mark_duplicate == []
+        assert mark_not_duplicate == [main_contact, dup_contact]
+
+
+class DuplicateJobLockTestCase(TestCase):
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_skipped_when_running(self, mock_request):
+        """
+        Tests that a run is skipped while another run holds the lock, and can run once it's released.
+        """
+        mock_request.side_effect = get_mock_response('mark_not_duplicate_contact')
+        lock = JobLock(Redis.from_url(app_settings.redis_url), 'duplicate-job', ttl=10)
+        assert lock.acquire()
+        update_duplicate_contacts()
+        assert not mock_request.called
+
+        lock.release()
+        update_duplicate_contacts()
+        assert mock_request.call_args_list[-1][0][0] == 'PUT'
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_stops_when_lock_lost(self, mock_request):
+        """
+        Tests that a run stops updating contacts once another run has taken over its lock.
+        """
+
+        def take_over(method, url, *args, **kwargs):
+            Redis.from_url(app_settings.redis_url).set('duplicate-job:lock', 'other')
+            return get_mock_response('mark_not_duplicate_contact')(method, url, *args, **kwargs)
+
+        mock_request.side_effect = take_over
+        with self.assertRaises(LockLost):
+            update_duplicate_contacts()
+        assert mock_request.call_args_list[-1][0][0] == 'GET'
+        Redis.from_url(app_settings.redis_url).delete('duplicate-job:lock')
+
+
+class ContactPagesTestCase(TestCase):
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_contacts_trimmed_when_decoded(self, mock_request):
+        """
+        Tests that contacts are trimmed to the fields we use as the page is decoded.
+        """
+        contact = {
+            **TEST_CONTACTS['main_contact'],
+            'created_at': 1,
+            'last_seen_at': 1,
+            'location': {'type': 'location', 'city': 'London'},
+            'tags': {'type': 'list', 'data': [{'type': 'tag', 'id': '1'}]},
+            'custom_attributes': {'is_duplicate': False, 'client_id': 123},
+        }
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps({'type': 'list', 'data': [contact], 'pages': {'type': 'pages'}}).encode()
+        mock_request.return_value = response
+
+        assert list(iter_contact_pages()) == [
+            [
+                {
+                    'id': 'main_contact',
+                    'email': 'test_main@test.com',
+                    'role': 'user',
+                    'created_at': 1,
+                    'last_seen_at': 1,
+                    'custom_attributes': {'is_duplicate': False},
+                }
+            ]
+        ]
+
+    def test_trimmed_page_memory(self):
+        """
+        Tests a page decoded with trim_contact_hook holds much less memory than the full page, using contacts shaped
+        like the ones Intercom returns.
+        """
+        emulator = IntercomEmulator()
+        for n in range(150):
+            emulator.add_contact(email=f'{n}@example.com', custom_attributes={f'attr_{i}': i for i in range(20)})
+        page = json.dumps({'type': 'list', 'data': list(emulator.contacts.values())})
+
+        def retained(**kwargs) -> int:
+            tracemalloc.start()
+            try:
+                data = json.loads(page, **kwargs)
+                size = tracemalloc.get_traced_memory()[0]
+                assert len(data['data']) == 150
+                return size
+            finally:
+                tracemalloc.stop()
+
+        assert retained(object_hook=trim_contact_hook) < retained() / 3
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_pages_prefetched(self, mock_request):
+        """
+        Tests the next pages are fetched while the current one is being used, without going past the pages we need.
+        """
+        recent = datetime.timestamp(datetime.now())
+
+        def contacts_page(method, url, *args, **kwargs):
+            page = 0 if 'starting_after' not in url else int(url.rsplit('=', 1)[1])
+            response = Response()
+            response.status_code = 200
+            response._content = json.dumps(
+                {
+                    'data': [{**TEST_CONTACTS['main_contact'], 'id': f'c{page}', 'last_seen_at': recent}],
+                    'pages': {'next': {'starting_after': page + 1} if page < 4 else None},
+                }
+            ).encode()
+            return response
+
+        mock_request.side_effect = contacts_page
+        failed_waits = []
+
+        class Slots(threading.Semaphore):
+            def acquire(self, blocking=True, timeout=None):
+                if not (acquired := super().acquire(blocking, timeout)):
+                    failed_waits.append(mock_request.call_count)
+                return acquired
+
+        def settled_calls() -> int:
+            # the second failed wait for a slot after a page is taken must have started after its slot was freed, so
+            # the prefetching thread is waiting with every slot full
+            failed_waits.clear()
+            end = time.monotonic() + 5
+            while len(failed_waits) < 2:
+                assert time.monotonic() < end, 'prefetching never waited for a slot'
+                time.sleep(0.01)
+            return mock_request.call_count
+
+        with mock.patch('tcintercom.app._mark_duplicate.threading.Semaphore', Slots):
+            pages = iter_contact_pages(prefetch=2)
+            assert next(pages)[0]['id'] == 'c0'
+            # the first page has been taken and two more have been fetched
+            assert settled_calls() == 3
+            assert next(pages)[0]['id'] == 'c1'
+            assert settled_calls() == 4
+            assert [page[0]['id'] for page in pages] == ['c2', 'c3', 'c4']
+        assert mock_request.call_count == 5
+        assert mock_request.call_args_list[1][0][1].endswith('/contacts?per_page=150&starting_after=1')
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_contacts_streamed(self, mock_request):
+        """
+        Tests contacts are yielded as each page arrives, before the next page is fetched, counting pages and contacts.
+        """
+        recent = datetime.timestamp(datetime.now())
+
+        def contacts_page(method, url, *args, **kwargs):
+            page = 0 if 'starting_after' not in url else int(url.rsplit('=', 1)[1])
+            response = Response()
+            response.status_code = 200
+            response._content = json.dumps(
+                {
+                    'data': [
+                        {**TEST_CONTACTS['main_contact'], 'id': f'c{page}_{n}', 'last_seen_at': recent}
+                        for n in range(2)
+                    ],
+                    'pages': {'next': {'starting_after': page + 1} if page < 2 else None},
+                }
+            ).encode()
+            return response
+
+        mock_request.side_effect = contacts_page
+        stats = RunStats()
+        token = current_run_stats.set(stats)
+        try:
+            with mock.patch.object(app_settings, 'contact_page_prefetch', 0):
+                contacts = iter_all_contacts()
+                assert next(contacts)['id'] == 'c0_0'
+                assert mock_request.call_count == 1
+                assert (stats.pages, stats.contacts) == (1, 2)
+                assert [c['id'] for c in contacts] == ['c0_1', 'c1_0', 'c1_1', 'c2_0', 'c2_1']
+        finally:
+            current_run_stats.reset(token)
+        assert (mock_request.call_count, stats.pages, stats.contacts) == (3, 3, 6)
+
+    @mock.patch('tcintercom.app.views.session.request')
+    def test_prefetch_error_raised(self, mock_request):
+        """
+        Tests an error fetching a page in the background is raised when the page is needed.
+        """
+        mock_request.side_effect = RequestException('Bad request')
+        with self.assertRaises(RequestException):
+            list(iter_contact_pages(prefetch=2))
@@ -0,0 +1,166 @@
+import asyncio
+import json
+from unittest import IsolatedAsyncioTestCase, mock
+
+from arq import create_pool
+from arq.constants import default_queue_name, job_key_prefix
+from requests import RequestException, Response
+
+from tcintercom.app._mark_duplicate import update_duplicate_custom_attribute
+from tcintercom.app.run_stats import RunStats, current_run_stats
+from tcintercom.app.settings import app_settings
+from tcintercom.app.write_queue import (
+    FINAL_CHECK_DELAY,
+    JOB_ID,
+    MERGE_PATCH,
+    PATCH_KEY,
+    enqueue_contact_update,
+    sweep_contact_updates,
+    write_contact_update,
+)
+from tests.test_workers import TEST_CONTACTS
+
+
+class WriteQueueTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.redis = await create_pool(app_settings.redis_settings)
+        await self.delete_keys()
+
+    async def asyncTearDown(self):
+        await self.delete_keys()
+        await self.redis.aclose()
+
+    async def delete_keys(self):
+        if jobs := await self.queued_job_ids():
+            await self.redis.zrem(default_queue_name, *jobs)
+        keys = [k async for k in self.redis.scan_iter(match=PATCH_KEY + '*')]
+        keys += [k async for k in self.redis.scan_iter(match=job_key_prefix + JOB_ID + '*')]
+        if keys:
+            await self.redis.delete(*keys)
+
+    async def queued_job_ids(self) -> list:
+        # only this app's write jobs, the queue may have others
+        return [j.decode() for j in await self.redis.zrange(default_queue_name, 0, -1) if j.startswith(JOB_ID.encode())]
+
+    async def test_updates_merged(self):
+        """
+        Tests that updates to the same contact are merged into one pending update with a single job.
+        """
+        await enqueue_contact_update(
+            self.redis, '123', {'role': 'user', 'email': 'a@x.com', 'custom_attributes': {'blog-subscribe': True}}
+        )
+        await enqueue_contact_update(
+            self.redis, '123', {'role': 'lead', 'email': 'a@x.com', 'custom_attributes': {'is_duplicate': True}}
+        )
+        await enqueue_contact_update(self.redis, '456', {'custom_attributes': {'is_duplicate': False}})
+
+        assert json.loads(await self.redis.get(PATCH_KEY + '123')) == {
+            'role': 'lead',
+            'email': 'a@x.com',
+            'custom_attributes': {'blog-subscribe': True, 'is_duplicate': True},
+        }
+        assert sorted(await self.queued_job_ids()) == [JOB_ID + '123', JOB_ID + '456']
+
+    @mock.patch('tcintercom.app.views.session.request')
+    async def test_write_contact_update(self, mock_request):
+        """
+        Tests the job sends the merged update in one PUT and clears it.
+        """
+        await enqueue_contact_update(self.redis, '123', {'email': 'a@x.com', 'custom_attributes': {'a': 1}})
+        await enqueue_contact_update(self.redis, '123', {'custom_attributes': {'b': 2}})
+
+        assert await write_contact_update({'redis': self.redis}, '123') == 1
+        assert mock_request.call_count == 1
+        assert mock_request.call_args[0][:2] == ('PUT', 'https://api.intercom.io/contacts/123')
+        assert mock_request.call_args[1]['json'] == {'email': 'a@x.com', 'custom_attributes': {'a': 1, 'b': 2}}
+        assert not await self.redis.exists(PATCH_KEY + '123')
+
+    @mock.patch('tcintercom.app.views.session.request')
+    async def test_update_while_finishing(self, mock_request):
+        """
+        Tests an update merged after the job found nothing left to write is still written by the job, rather than
+        waiting for the sweep as its own job is rejected while this one exists.
+        """
+        await enqueue_contact_update(self.redis, '123', {'custom_attributes': {'a': 1}})
+
+        sleep = asyncio.sleep
+        arrived = []
+
+        async def update_arrives(delay, *args):
+            if delay == FINAL_CHECK_DELAY and not arrived:
+                arrived.append(delay)
+                await enqueue_contact_update(self.redis, '123', {'custom_attributes': {'b': 2}})
+            else:
+                await sleep(0)
+
+        with mock.patch('tcintercom.app.write_queue.asyncio.sleep', update_arrives):
+            assert await write_contact_update({'redis': self.redis}, '123') == 2
+        assert [c[1]['json'] for c in mock_request.call_args_list] == [
+            {'custom_attributes': {'a': 1}},
+            {'custom_attributes': {'b': 2}},
+        ]
+        assert not await self.redis.exists(PATCH_KEY + '123')
+
+    @mock.patch('tcintercom.app.views.session.request')
+    async def test_rejected_write_dropped(self, mock_request):
+        """
+        Tests an update Intercom rejects, eg. for a deleted contact, is dropped rather than retried by the sweep.
+        """
+        not_found = Response()
+        not_found.status_code = 404
+        mock_request.return_value = not_found
+        await enqueue_contact_update(self.redis, '123', {'custom_attributes': {'a': 1}})
+
+        assert await write_contact_update({'redis': self.redis}, '123') == 0
+        assert not await self.redis.exists(PATCH_KEY + '123')
+        await self.redis.zrem(default_queue_name, JOB_ID + '123')
+        await self.redis.delete(job_key_prefix + JOB_ID + '123')
+        await sweep_contact_updates({'redis': self.redis})
+        assert await self.queued_job_ids() == []
+
+    @mock.patch('tcintercom.app.views.session.request')
+    async def test_failed_write_kept(self, mock_request):
+        """
+        Tests that a failed write is put back, under any newer updates, and queued again by the sweep.
+        """
+        mock_request.side_effect = RequestException('Bad request')
+        update = {'email': 'a@x.com', 'custom_attributes': {'a': 1, 'b': 1}}
+        await enqueue_contact_update(self.redis, '123', update)
+        with self.assertRaises(RequestException):
+            await write_contact_update({'redis': self.redis}, '123')
+        assert json.loads(await self.redis.get(PATCH_KEY + '123')) == update
+
+        await self.redis.set(PATCH_KEY + '123', json.dumps({'custom_attributes': {'a': 2}}))
+        await self.redis.eval(MERGE_PATCH, 1, PATCH_KEY + '123', json.dumps(update), 'under')
+        assert json.loads(await self.redis.get(PATCH_KEY + '123')) == {
+            'email': 'a@x.com',
+            'custom_attributes': {'a': 2, 'b': 1},
+        }
+
+        await self.redis.zrem(default_queue_name, JOB_ID + '123')
+        await self.redis.delete(job_key_prefix + JOB_ID + '123')
+        await sweep_contact_updates({'redis': self.redis})
+        assert await self.queued_job_ids() == [JOB_ID + '123']
+
+    @mock.patch('tcintercom.app.settings.app_settings.contact_write_queue', True)
+    @mock.patch('tcintercom.app.views.session.request')
+    async def test_duplicate_updates_queued(self, mock_request):
+        """
+        Tests the cron job queues its updates rather than writing them when the write queue is on.
+        """
+        contact = TEST_CONTACTS['marked_duplicate_contact']
+        stats = RunStats()
+        token = current_run_stats.set(stats)
+        # update_duplicate_custom_attribute runs its own event loop to queue the updates
+        updated = await asyncio.to_thread(update_duplicate_custom_attribute, [contact], False)
+        current_run_stats.reset(token)
+
+        assert updated == 0
+        assert stats.queued == 1
+        assert not mock_request.called
+        assert await self.queued_job_ids() == [JOB_ID + contact['id']]
+        assert json.loads(await self.redis.get(PATCH_KEY + contact['id'])) == {
+            'role': 'user',
+            'email': contact['email'],
+            'custom_attributes': {'is_duplicate': False},
+        }